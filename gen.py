@@ -3,10 +3,13 @@
 Feature Doc & Token Aggregator (with logging)
 
 - Recursively scans all .rs files (skips common build/hidden dirs)
-- Summarizes each file (~4000-token budget via ~12k chars)
-- Calls a local LLM (LM Studio) to:
-  1) score ALL features and pick a primary
-  2) emit compact tokens for EVERY sufficiently matching feature
+- Summarizes each file (MAX_PROMPT_TOKENS budget; ~3 chars/token without tiktoken)
+- Classifies each changed file with a local LLM (LM Studio) in ONE request that
+  scores ALL features, picks a primary and emits compact tokens for every
+  sufficiently matching feature. Small files share a request (micro-batch), files
+  dominated by one feature's keywords skip the LLM, and --two-call splits
+  scoring and tokens into separate requests.
+- Caches results per file (content hash) in SQLite, so unchanged files need no LLM call
 - Aggregates tokens globally and generates per-feature docs
 
 Now includes detailed logging:
@@ -17,32 +20,79 @@ Now includes detailed logging:
 
 import os
 import re
+import atexit
 import sys
 import json
 import time
 import textwrap
 import hashlib
+import itertools
+import heapq
 import logging
+import logging.handlers
+import functools
+import queue
+import random
+import sqlite3
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Optional: orjson (C-backed) for parsing responses and (de)serializing the caches;
+# stdlib json otherwise.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: tiktoken to budget summaries in tokens rather than characters.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Optional: xxhash (xxh3, SIMD) for the per-file content hash; SHA1 otherwise.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Optional: google-re2 (DFA-backed, linear time) for the per-file source scans.
+try:
+    import re2 as _re
+except ImportError:
+    _re = re
 
 # --------------------------
 # Logging setup
 # --------------------------
 LOG_LEVEL = logging.INFO  # change to logging.DEBUG for more noise
-logging.basicConfig(
-    level=LOG_LEVEL,
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    datefmt="%H:%M:%S",
-)
+# Records go through a queue and are written to stderr by a listener thread, so
+# logging from the scan/LLM workers and the merge loop never blocks on IO.
+_LOG_QUEUE: "queue.Queue" = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s", datefmt="%H:%M:%S"))
+_log_enqueue = logging.handlers.QueueHandler(_LOG_QUEUE)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))  # merges args; layout is applied by _log_stream
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_enqueue])
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _log_stream)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)  # flush what is still queued
 logger = logging.getLogger("gen")
 
-# Track failures for end-of-run summary
+# Track failures for end-of-run summary (appended from worker threads)
 FAILED_CALLS: List[dict] = []
+_FAILED_LOCK = threading.Lock()
 
-# Progress tracking (set in main)
-TOTAL_FILES: int = 0
-CURRENT_FILE_IDX: int = 0
+# Per-file "[i/N] " progress label; thread-local because files are processed
+# concurrently. N comes from RunCtx.total_files.
+_PROGRESS = threading.local()
 
 # --------------------------
 # Fixed model & behavior (no env)
@@ -54,20 +104,82 @@ LM_BASE  = "http://127.0.0.1:1234"
 LM_MODEL = "qwen2.5-coder-7b-instruct"
 TEMPERATURE = 0.0
 
+# Files processed concurrently (= max in-flight LLM requests); keeps LM Studio's
+# batching scheduler busy without flooding it. See --concurrency.
+LM_CONCURRENCY = 32
+# Threads reading/hashing/summarizing files ahead of the LLM pool. Reads and
+# SHA1 over large buffers release the GIL, so a few workers overlap the IO.
+SCAN_WORKERS = 4
+# Busy/overloaded answers (429, 5xx) are retried on the same endpoint with
+# exponential backoff + jitter (or the server's Retry-After) before they count
+# as a failure.
+LM_TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+LM_TRANSIENT_RETRIES = 3
+LM_BACKOFF_BASE = 1.0
+LM_BACKOFF_MAX = 30.0
+# (connect, read) timeouts for LLM calls. The server is local, so a connect that
+# takes more than a few seconds means it is down; read covers slow generations.
+LM_TIMEOUT = (5, 120)
+# Stream completions and hang up as soon as a complete JSON object has arrived,
+# so the model stops decoding trailing prose. LM_MAX_TOKENS caps one file's answer.
+LM_STREAM = True
+LM_MAX_TOKENS = 1536
+# Ask the server to keep the KV cache of the prompt prefix between requests
+# (llama.cpp-style "cache_prompt"; servers that don't know it ignore it). Every
+# prompt starts with the same system message + FEATURES block, so only the file
+# summary tail needs fresh prefill.
+LM_CACHE_PROMPT = True
+
+# One pooled HTTP session shared by every LLM call so Keep-Alive reuses the socket
+# to the LM server instead of paying connection setup per request. One keep-alive
+# connection per worker; pool_block makes any extra caller wait for a free
+# connection instead of opening a throwaway one.
+_SESSION = requests.Session()
+
+def _mount_session_pool(size: int):
+    _SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=size,
+                                          pool_block=True, max_retries=0))
+
+_mount_session_pool(LM_CONCURRENCY)
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Micro-batching: small files that miss the cache are classified up to
+# SCORE_BATCH_SIZE per request, as long as their summaries fit SCORE_BATCH_TOKENS
+# together (so a batch prompt is no larger than a single-file one). See --batch-size.
+SCORE_BATCH_SIZE = 4
+SCORE_BATCH_TOKENS = 3500
+
+# Scores and tokens come back from one combined request per file (or batch). Models
+# that can't follow the combined schema can use the older two-request path instead
+# (score, then tokens for the candidates); that path is never batched. See --two-call.
+LM_TWO_CALL = False
+
 # Multi-feature token aggregation knobs
 SCORE_MIN = 0.55   # include tokens for any feature with score >= SCORE_MIN
 TOP_K_FALLBACK = 2 # ensure at least K features per file get tokens
 
-# Context budget: ~4000 tokens default → ~12k chars (conservative)
-MAX_SUMMARY_CHARS = 12000
+# Context budget for one file summary, in tokens. Counted with tiktoken when it is
+# available; otherwise CHARS_PER_TOKEN chars stand in for one token (conservative),
+# both when trimming and when counting, so a full summary still fits SCORE_BATCH_TOKENS.
+MAX_PROMPT_TOKENS = 3500
+CHARS_PER_TOKEN = 3
 
 # Output & cache
 ROOT      = Path(os.getcwd()).resolve()
 OUT_DIR   = ROOT / "docs" / "project-index"
 CACHE_DIR = ROOT / ".cache"
 CACHE_DIR.mkdir(exist_ok=True)
-CLASSIFY_CACHE_FILE = CACHE_DIR / "feature_map_cache.json"   # per-file class scores + primary
+CLASSIFY_DB_FILE    = CACHE_DIR / "cache.sqlite"             # per-file class scores + primary + tokens, and summaries
+CLASSIFY_CACHE_FILE = CACHE_DIR / "feature_map_cache.json"   # legacy JSON cache, imported once into CLASSIFY_DB_FILE
+SUMMARY_CACHE_VERSION = 2  # bump when summarize_for_llm output changes
+MODEL_PROBE_FILE    = CACHE_DIR / "model_probe.json"         # last /v1/models answer, reused for MODEL_PROBE_TTL_SEC
+MODEL_PROBE_TTL_SEC = 300
 TOKENS_DB_FILE      = OUT_DIR / "feature_tokens.json"        # global token index
+FEATURE_MAP_FILE    = OUT_DIR / "feature_map.json"
+# Incremental feature-map writes happen in the background (see Persistor), at
+# most once per SAVE_PROGRESS_EVERY merged files or PERSIST_INTERVAL_SEC, whichever first.
+SAVE_PROGRESS_EVERY = 16
+PERSIST_INTERVAL_SEC = 5.0
 
 # Files/dirs walking
 IGNORE_DIRS = {
@@ -75,8 +187,10 @@ IGNORE_DIRS = {
 }
 INCLUDE_EXT = {".rs"}
 
-# Public API line detection (for summaries / API lists)
-PUB_ITEM_RE = re.compile(r"(?m)^(pub\s+(?:struct|enum|trait|fn)\s+[A-Za-z0-9_]+)")
+# Public API line detection (for summaries / API lists). Inline (?m) keeps the
+# pattern valid for both `re` and `re2`.
+PUB_ITEM_RE = _re.compile(r"(?m)^(pub\s+(?:struct|enum|trait|fn)\s+[A-Za-z0-9_]+)")
+PUB_ITEM_RE_BYTES = _re.compile(PUB_ITEM_RE.pattern.encode("ascii"))  # same scan on undecoded sources
 
 # --------------------------
 # Fixed feature set (no paths/regex) — edit only when you add/remove features
@@ -120,6 +234,49 @@ FEATURES: List[Dict] = [
 # Quick slug->title map for docs (feature_map will no longer store titles)
 FEATURE_TITLES = {f["slug"]: f.get("title", f["slug"]) for f in FEATURES}
 
+# Distinctive identifier words per feature, picked from the prompts above, for the
+# keyword fast path (see keyword_classify). Words are matched against the
+# lowercased CamelCase/snake_case parts of the summary, so keep them single words
+# and specific enough that a file full of them clearly belongs to the feature.
+# Fast-path cache entries are tagged with KEYWORD_TABLE_VERSION: bump it when the
+# table or thresholds change so those files are classified again. See --no-keywords.
+KEYWORD_FAST_PATH = True
+KEYWORD_TABLE_VERSION = 2
+KEYWORD_MIN_SHARE = 0.8   # top feature's share of all keyword hits
+KEYWORD_MIN_HITS = 8
+KEYWORD_MIN_DISTINCT = 3  # distinct keywords of the top feature, so one repeated word can't decide
+FEATURE_KEYWORDS: Dict[str, List[str]] = {
+    "snapshots": ["snapshot", "snapshots"],
+    "state": ["state", "remember", "ownership", "owned"],
+    "composer_runtime": ["composer", "recompose", "recomposition", "slot", "slots", "applier",
+                         "invalidate", "invalidation"],
+    "effects": ["effect", "effects", "disposable", "launched"],
+    "frame_clock": ["frame", "clock", "vsync", "nanos", "millis"],
+    "layout": ["measure", "measurable", "placeable", "constraints", "intrinsic", "placement"],
+    "modifiers": ["modifier", "modifiers"],
+    "rendering": ["render", "renderer", "wgpu", "pixels", "draw", "gpu"],
+    "animation": ["animate", "animatable", "animation", "tween", "spring", "easing"],
+    "composition_local": ["local", "locals", "provider", "providers", "ambient"],
+    "input": ["pointer", "keyboard", "focus", "gesture"],
+    "platform_desktop": ["winit", "window", "desktop"],
+    "app_shell": ["app", "application", "shell"],
+    "widgets": ["button", "column", "row", "spacer", "widget"],
+    "subcompose": ["subcompose", "subcomposed", "subcomposition"],
+    "diagnostics": ["tracing", "trace", "inspector", "diagnostics"],
+}
+_KEYWORD_OWNER = {kw: slug for slug, kws in FEATURE_KEYWORDS.items() for kw in kws}
+
+@dataclass(frozen=True)
+class RunCtx:
+    """Settings resolved once in main (CLI flags, model probe, file count) and
+    passed to the workers. The module constants above are only the defaults."""
+    lm_model: str = LM_MODEL
+    total_files: int = 0
+    two_call: bool = LM_TWO_CALL
+    concurrency: int = LM_CONCURRENCY
+    batch_size: int = SCORE_BATCH_SIZE
+    keyword_fast_path: bool = KEYWORD_FAST_PATH
+
 # ==========================
 # Helpers
 # ==========================
@@ -127,33 +284,99 @@ FEATURE_TITLES = {f["slug"]: f.get("title", f["slug"]) for f in FEATURES}
 def sha1_bytes(b: bytes) -> str:
     return hashlib.sha1(b).hexdigest()
 
-def list_rust_files(root: Path) -> List[Path]:
-    files: List[Path] = []
-    for dirpath, dirnames, filenames in os.walk(root):
-        dirnames[:] = [d for d in dirnames if d not in IGNORE_DIRS and not d.startswith(".")]
-        for fn in filenames:
-            p = Path(dirpath) / fn
-            if p.suffix in INCLUDE_EXT:
-                files.append(p)
-    return files
-
-def read_text(path: Path) -> str:
-    try:
-        return path.read_text(encoding="utf-8")
-    except UnicodeDecodeError:
-        return path.read_text(encoding="utf-8", errors="ignore")
+def content_hash(b: bytes) -> str:
+    """Hash of a file's raw bytes for the caches (not security-relevant).
+
+    xxh3 hashes carry an "xxh3:" prefix; SHA1 hashes stay bare hex so caches
+    written before xxhash support keep matching. Switching between the two
+    misses the cache once per file.
+    """
+    if xxhash is not None:
+        return "xxh3:" + xxhash.xxh3_64_hexdigest(b)
+    return sha1_bytes(b)
+
+def cache_key(file_hash: str, model: str = LM_MODEL) -> str:
+    """Classification cache key: content hash + taxonomy + model, so any of them changing forces a re-run."""
+    return f"{file_hash}:{TAXONOMY_VERSION}:{model}"
+
+def write_atomic(path: Path, data: Union[str, bytes]):
+    """Write via a sibling temp file + rename so readers never see a half-written file."""
+    tmp = path.with_suffix(".tmp")
+    if isinstance(data, str):
+        tmp.write_text(data, encoding="utf-8")
+    else:
+        tmp.write_bytes(data)
+    tmp.replace(path)
+
+def dump_json(obj) -> bytes:
+    """Pretty-printed UTF-8 JSON; uses orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+def dump_json_line(obj) -> bytes:
+    """Compact single-line UTF-8 JSON (no trailing newline)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+# Parses str or bytes; both raise a ValueError subclass on bad input.
+load_json = orjson.loads if orjson is not None else json.loads
+
+def iter_rust_files(root: Path) -> Iterator[Tuple[str, str]]:
+    """Yield (absolute path, path relative to root) strings of source files under root.
+
+    Uses os.scandir so directory/file checks come from the DirEntry (no extra
+    stat per entry) and no Path object is built for skipped entries.
+    """
+    suffixes = tuple(INCLUDE_EXT)
+    prefix = len(str(root).rstrip(os.sep)) + 1
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue  # unreadable directory; os.walk skipped these too
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name not in IGNORE_DIRS and not e.name.startswith("."):
+                        stack.append(e.path)
+                elif e.name.endswith(suffixes):
+                    yield e.path, e.path[prefix:]
+
+def list_rust_files(root: Path) -> List[Tuple[str, str]]:
+    return list(iter_rust_files(root))
+
+def read_bytes(path: Union[str, Path]) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def decode_source(raw: bytes) -> str:
+    """Decode like text-mode reading did: UTF-8 (invalid bytes dropped), universal newlines."""
+    s = raw.decode("utf-8", errors="ignore")
+    if "\r" in s:
+        s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return s
+
+def decode_head(raw: bytes, n_lines: int) -> str:
+    """Decode only the first n_lines lines of raw."""
+    return decode_source(b"\n".join(raw.split(b"\n", n_lines)[:n_lines]))
 
 def extract_public_items(code: str, limit: int = 64) -> List[str]:
-    items = [m for m in PUB_ITEM_RE.findall(code)]
-    return items[:limit]
+    # Stop scanning once `limit` items are found instead of matching the whole file.
+    return [m.group(1) for m in itertools.islice(PUB_ITEM_RE.finditer(code), limit)]
 
-def extract_leading_docs(code: str, max_lines: int = 120) -> str:
-    lines = code.splitlines()
+def extract_leading_docs(code: str, max_lines: int = 120, lines: Optional[List[str]] = None) -> str:
+    """Leading comment/doc block plus the first code lines. Pass `lines` to reuse an existing splitlines()."""
+    if lines is None:
+        lines = code.splitlines()
     collected = []
     opened_block = False
     for i, ln in enumerate(lines[:max_lines]):
         s = ln.strip()
-        if s.startswith("//!") or s.startswith("///") or s.startswith("//"):
+        if s.startswith("//"):  # also covers //! and /// doc comments
             collected.append(ln)
             continue
         if s.startswith("/*"):
@@ -177,12 +400,42 @@ def truncate_chars(s: str, limit: int) -> str:
     return head[:last_nl] if last_nl > limit * 0.8 else head
 
 
+def _load_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:  # e.g. BPE file not cached and no network
+        logger.warning("tiktoken unavailable (%s); budgeting summaries by characters", e)
+        return None
+
+_ENC = _load_encoding()
+
+def count_tokens(s: str) -> int:
+    if _ENC is None:
+        return len(s) // CHARS_PER_TOKEN
+    return len(_ENC.encode(s, disallowed_special=()))
+
+def truncate_tokens(s: str, limit: int) -> str:
+    """Trim s to `limit` tokens, preferring a line boundary like truncate_chars."""
+    if _ENC is None:
+        return truncate_chars(s, limit * CHARS_PER_TOKEN)
+    ids = _ENC.encode(s, disallowed_special=())
+    if len(ids) <= limit:
+        return s
+    head = _ENC.decode(ids[:limit])
+    last_nl = head.rfind("\n")
+    return head[:last_nl] if last_nl > len(head) * 0.8 else head
+
+SUMMARY_PATH_PREFIX = "PATH (for context only): "
+
 def summarize_for_llm(path: str, code: str) -> str:
-    leading = extract_leading_docs(code, max_lines=160)
+    lines = code.splitlines()
+    leading = extract_leading_docs(code, max_lines=160, lines=lines)
     apis = extract_public_items(code, limit=64)
     apis_block = "- " + "\n- ".join(apis) if apis else "- (no public items found)"
-    body_tail = "\n".join(code.splitlines()[-80:])
-    raw = f"""PATH (for context only): {path}
+    body_tail = "\n".join(lines[-80:])
+    raw = f"""{SUMMARY_PATH_PREFIX}{path}
 
 PUBLIC_APIS:
 {apis_block}
@@ -193,7 +446,7 @@ HEAD_DOCS_OR_CODE:
 CODE_TAIL:
 {body_tail}
 """
-    return truncate_chars(raw, MAX_SUMMARY_CHARS)
+    return truncate_tokens(raw, MAX_PROMPT_TOKENS)
 
 # ==========================
 # HTTP / LLM helpers with logging + retry
@@ -203,18 +456,43 @@ def _shorten(s: str, n: int = 800) -> str:
     s = s or ""
     return (s[:n] + "…") if len(s) > n else s
 
+def _record_failure(rec: dict):
+    with _FAILED_LOCK:
+        FAILED_CALLS.append(rec)
+
+def _retry_delay(n: int, retry_after: Optional[str]) -> float:
+    """Seconds to wait before transient retry n (0-based)."""
+    try:
+        return min(LM_BACKOFF_MAX, max(0.0, float(retry_after)))
+    except (TypeError, ValueError):
+        pass
+    return min(LM_BACKOFF_MAX, LM_BACKOFF_BASE * 2 ** n) * random.uniform(0.5, 1.0)
+
+def _post_lm(url: str, body: bytes, progress: str, phase: str, relpath: str) -> requests.Response:
+    """POST to the LM server, retrying LM_TRANSIENT_STATUS answers with backoff.
+
+    Returns the final response (the caller closes it), whatever its status.
+    """
+    n = 0
+    while True:
+        r = _SESSION.post(url, data=body, headers=_JSON_HEADERS, timeout=LM_TIMEOUT, stream=LM_STREAM)
+        if r.status_code not in LM_TRANSIENT_STATUS or n >= LM_TRANSIENT_RETRIES:
+            return r
+        delay = _retry_delay(n, r.headers.get("Retry-After"))
+        r.close()
+        logger.warning("%sAPI %s busy (%s) for %s | url=%s | retrying in %.1fs",
+                       progress, phase, r.status_code, relpath, url, delay)
+        time.sleep(delay)
+        n += 1
+
 def http_json_chat(payload: Dict, phase: str, relpath: str, tries: int = 2, backoff_sec: float = 0.8) -> Optional[Dict]:
     """
     POSTs to LM_URL and returns parsed JSON (requests JSON, not model content).
     On failure, logs details and returns None.
     Retries a couple of times with simple backoff.
     """
-    import requests
     # include current progress in logs if available
-    try:
-        progress = f"[{CURRENT_FILE_IDX}/{TOTAL_FILES}] " if TOTAL_FILES else ""
-    except Exception:
-        progress = ""
+    progress = getattr(_PROGRESS, "label", "")
 
     # Use only OpenAI-like supported endpoints to avoid LM server warnings.
     # We'll try chat completions first, then fallback to non-chat completions
@@ -243,28 +521,41 @@ def http_json_chat(payload: Dict, phase: str, relpath: str, tries: int = 2, back
                     prompt = messages_to_prompt(msgs) if msgs else payload.get("prompt") or ""
                     send = {"model": payload.get("model", LM_MODEL), "prompt": prompt, "temperature": payload.get("temperature", 0.0)}
                 else:
-                    send = payload
+                    send = dict(payload)
+                send["max_tokens"] = payload.get("max_tokens", LM_MAX_TOKENS)
+                if LM_STREAM:
+                    send["stream"] = True
+                if LM_CACHE_PROMPT:
+                    send["cache_prompt"] = True
 
                 logger.info("%sLLM call %s -> %s | url=%s", progress, phase, relpath, url)
-                r = requests.post(url, json=send, timeout=120)
-                if r.status_code != 200:
-                    logger.error("%sAPI %s FAILED (%s) for %s | url=%s | status=%s | body=%s",
-                                 progress, phase, attempt, relpath, url, r.status_code, _shorten(r.text))
-                    FAILED_CALLS.append({"phase": phase, "file": relpath, "url": url, "status": r.status_code, "body": r.text[:4000]})
-                    time.sleep(backoff_sec * attempt)
-                    continue
-                try:
-                    logger.debug("API %s SUCCESS for %s | url=%s | status=%s", phase, relpath, url, r.status_code)
-                    return r.json()
-                except Exception as je:
-                    logger.error("%sAPI %s JSON PARSE FAILED for %s | url=%s | err=%s | body=%s",
-                                 progress, phase, relpath, url, je, _shorten(r.text))
-                    FAILED_CALLS.append({"phase": phase, "file": relpath, "url": url, "status": r.status_code, "body": r.text[:4000]})
-                    time.sleep(backoff_sec * attempt)
+                # Leaving the `with` block early closes a still-streaming response,
+                # which tells the server to stop generating.
+                # Bodies are encoded with dump_json_line (orjson when installed) rather
+                # than requests' stdlib json= encoder.
+                with _post_lm(url, dump_json_line(send), progress, phase, relpath) as r:
+                    if r.status_code != 200:
+                        logger.error("%sAPI %s FAILED (%s) for %s | url=%s | status=%s | body=%s",
+                                     progress, phase, attempt, relpath, url, r.status_code, _shorten(r.text))
+                        _record_failure({"phase": phase, "file": relpath, "url": url, "status": r.status_code, "body": r.text[:4000]})
+                        time.sleep(backoff_sec * attempt)
+                        continue
+                    if "text/event-stream" in r.headers.get("Content-Type", ""):
+                        logger.debug("API %s STREAM for %s | url=%s", phase, relpath, url)
+                        # Same shape as a non-streamed chat response, for either endpoint.
+                        return {"choices": [{"message": {"content": _read_event_stream(r)}}]}
+                    try:
+                        logger.debug("API %s SUCCESS for %s | url=%s | status=%s", phase, relpath, url, r.status_code)
+                        return load_json(r.content)
+                    except Exception as je:
+                        logger.error("%sAPI %s JSON PARSE FAILED for %s | url=%s | err=%s | body=%s",
+                                     progress, phase, relpath, url, je, _shorten(r.text))
+                        _record_failure({"phase": phase, "file": relpath, "url": url, "status": r.status_code, "body": r.text[:4000]})
+                        time.sleep(backoff_sec * attempt)
             except Exception as e:
                 last_exc = e
                 logger.error("%sAPI %s EXCEPTION for %s | url=%s | err=%s", progress, phase, relpath, url, e)
-                FAILED_CALLS.append({"phase": phase, "file": relpath, "url": url, "status": None, "body": str(e)})
+                _record_failure({"phase": phase, "file": relpath, "url": url, "status": None, "body": str(e)})
                 time.sleep(backoff_sec * attempt)
 
     if last_exc:
@@ -272,43 +563,160 @@ def http_json_chat(payload: Dict, phase: str, relpath: str, tries: int = 2, back
     return None
 
 
+class _JsonStreamScanner:
+    """Incremental _json_object_end over streamed model output.
+
+    feed() returns True once the first complete *and parseable* JSON object has
+    arrived (kept in .result); a brace pair that does not parse (e.g. "{path}"
+    in prose) is skipped and scanning continues.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.result = None
+        self._pos = 0
+        self._start = -1
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    def feed(self, piece: str) -> bool:
+        self.text += piece
+        s = self.text
+        for j in range(self._pos, len(s)):
+            c = s[j]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+            elif c == '"':
+                # quotes only start strings inside an object, not in surrounding prose
+                self._in_str = self._depth > 0
+            elif c == "{":
+                if self._depth == 0:
+                    self._start = j
+                self._depth += 1
+            elif c == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        self.result = load_json(s[self._start:j + 1])
+                    except ValueError:
+                        continue
+                    self._pos = j + 1
+                    return True
+        self._pos = len(s)
+        return False
+
+def _read_event_stream(r) -> str:
+    """Collect OpenAI-style SSE deltas (chat `delta.content` or completions `text`).
+
+    Stops reading as soon as a complete JSON object has been received.
+    """
+    scanner = _JsonStreamScanner()
+    for line in r.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        try:
+            choice = (load_json(data).get("choices") or [{}])[0]
+        except ValueError:
+            continue
+        piece = (choice.get("delta") or {}).get("content") or choice.get("text") or ""
+        if piece and scanner.feed(piece):
+            break
+    return scanner.text
+
+def _json_object_end(s: str, start: int) -> int:
+    """Index just past the '}' matching the '{' at s[start], or -1 if it never closes.
+
+    Tracks string/escape state so braces inside JSON strings are ignored.
+    """
+    depth = 0
+    in_str = False
+    esc = False
+    for j in range(start, len(s)):
+        c = s[j]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return j + 1
+    return -1
+
 def _extract_json_blob(s: str) -> str:
     """Try to extract a JSON object from model content.
 
     Handles cases where the assistant wraps JSON in markdown fences (```json ... ```)
     or includes surrounding commentary. Returns original string if no JSON found.
+    Single left-to-right scan: no regex, and trailing prose containing braces
+    does not extend the match.
     """
     if not s:
         return s
-    # Strip common triple-backtick fences
-    # Look for ```json ... ``` or ``` ... ```
-    m = re.search(r"```(?:json)?\s*(.*?)\s*```", s, re.S | re.I)
-    if m:
-        return m.group(1).strip()
-
-    # Fallback: find first { and the matching last }
-    first = s.find("{")
-    last = s.rfind("}")
-    if first != -1 and last != -1 and last > first:
-        return s[first:last+1]
-
-    # Nothing obvious — return original to allow json.loads to raise a helpful error
-    return s
+    brace = s.find("{")
+    fence = s.find("```")
+    # A fence that opens before the object: look inside it (```json ... ``` or ``` ... ```)
+    if fence != -1 and (brace == -1 or fence < brace):
+        body = fence + 3
+        if s[body:body + 4].lower() == "json":
+            body += 4
+        close = s.find("```", body)
+        inner = s[body:close] if close != -1 else s[body:]
+        return _extract_json_blob(inner.strip()) if "{" in inner else inner.strip()
+    if brace == -1:
+        # Nothing obvious — return original to allow load_json to raise a helpful error
+        return s
+    end = _json_object_end(s, brace)
+    return s[brace:end] if end != -1 else s[brace:]
 
 
+@functools.lru_cache(maxsize=1)
 def probe_available_model() -> Optional[str]:
     """Query the server's /v1/models and return the first model id if successful.
 
-    Returns None on failure.
+    A successful answer is kept in MODEL_PROBE_FILE and reused for
+    MODEL_PROBE_TTL_SEC, so quick re-runs (e.g. from a watch loop) skip the
+    request. Returns None on failure.
     """
-    import requests
+    try:
+        hit = load_json(MODEL_PROBE_FILE.read_bytes())
+        if hit.get("base") == LM_BASE and time.time() - hit.get("at", 0) < MODEL_PROBE_TTL_SEC:
+            return hit["model"]
+    except Exception:
+        pass  # no usable cached probe
+
+    found = _probe_models_endpoint()
+    if found:
+        try:
+            write_atomic(MODEL_PROBE_FILE, dump_json({"base": LM_BASE, "model": found, "at": time.time()}))
+        except OSError as e:
+            logger.debug("Could not cache model probe: %s", e)
+    return found
+
+def _probe_models_endpoint() -> Optional[str]:
     url = f"{LM_BASE.rstrip('/')}/v1/models"
     try:
-        r = requests.get(url, timeout=6)
+        r = _SESSION.get(url, timeout=6)
         if r.status_code != 200:
             logger.debug("Model probe failed status=%s body=%s", r.status_code, _shorten(r.text))
             return None
-        data = r.json()
+        data = load_json(r.content)
         arr = data.get("data") or []
         if not arr:
             return None
@@ -322,92 +730,433 @@ def probe_available_model() -> Optional[str]:
 # LLM Calls (with logging)
 # ==========================
 
-def lm_score_features(features: List[Dict], file_summary: str, relpath: str) -> Dict:
-    system = {"role": "system", "content": textwrap.dedent("""
-        You classify Rust source content into a fixed feature set for a Jetpack-Compose-like framework.
-        - Use ONLY the provided summary (APIs + docs/tail). Ignore file paths for decision.
-        - Score EVERY feature from 0.0 to 1.0 by fitness.
-        - Select ONE primary feature with a confidence (0..1).
-        Return strict JSON: {"scores":{"<slug>":0.0..1.0,...},"primary":"<slug>","confidence":0.0..1.0}
-    """).strip()}
+# Prompt pieces that do not depend on the file are built once at import.
+def _features_block(features: List[Dict]) -> str:
     feat_lines = [f"- {f['slug']}: {f['title']} || What to look for: {f.get('prompt','')}" for f in features]
-    user = {"role": "user", "content": "Allowed features:\n" + "\n".join(feat_lines) + "\n\nFILE SUMMARY:\n" + file_summary}
-    payload = {"model": LM_MODEL, "temperature": TEMPERATURE, "messages": [system, user]}
+    return "Allowed features:\n" + "\n".join(feat_lines) + "\n\n"
+
+def _score_user_prefix(features: List[Dict]) -> str:
+    return _features_block(features) + "FILE SUMMARY:\n"
+
+SCORE_USER_PREFIX = _score_user_prefix(FEATURES)
+BATCH_USER_PREFIX = _features_block(FEATURES) + "FILES:\n"
+
+SYSTEM_SCORE = {"role": "system", "content": textwrap.dedent("""
+    You classify Rust source content into a fixed feature set for a Jetpack-Compose-like framework.
+    - Use ONLY the provided summary (APIs + docs/tail). Ignore file paths for decision.
+    - Score EVERY feature from 0.0 to 1.0 by fitness.
+    - Select ONE primary feature with a confidence (0..1).
+    Return strict JSON: {"scores":{"<slug>":0.0..1.0,...},"primary":"<slug>","confidence":0.0..1.0}
+""").strip()}
+
+SYSTEM_SCORE_AND_TOKENS = {"role": "system", "content": textwrap.dedent(f"""
+    You classify Rust source content into a fixed feature set for a Jetpack-Compose-like framework.
+    - Use ONLY the provided summary (APIs + docs/tail). Ignore file paths for decision.
+    - Score EVERY feature from 0.0 to 1.0 by fitness.
+    - Select ONE primary feature with a confidence (0..1).
+    - For every feature with score >= {SCORE_MIN} OR among the top {TOP_K_FALLBACK} scores, also emit
+      8–20 compact, code-friendly tokens (1–3 words). Prefer public type/function names and key terms.
+    Return strict JSON: {{"scores":{{"<slug>":0.0..1.0,...}},"primary":"<slug>","confidence":0.0..1.0,
+    "features":{{"<slug>":[{{"token":"...","weight":0..1}}, ...], ...}}}}
+""").strip()}
+
+SYSTEM_SCORE_BATCH = {"role": "system", "content": textwrap.dedent(f"""
+    You classify SEVERAL Rust source files into a fixed feature set for a Jetpack-Compose-like framework.
+    Each file is given as "[n] <path>" followed by its summary between <<< and >>>.
+    For EACH file independently:
+    - Use ONLY its summary (APIs + docs/tail). Ignore file paths for decision.
+    - Score EVERY feature from 0.0 to 1.0 by fitness.
+    - Select ONE primary feature with a confidence (0..1).
+    - For every feature with score >= {SCORE_MIN} OR among the top {TOP_K_FALLBACK} scores, also emit
+      8–20 compact, code-friendly tokens (1–3 words). Prefer public type/function names and key terms.
+    Return strict JSON with exactly one result per file, "idx" being the file's n:
+    {{"results":[{{"idx":1,"scores":{{"<slug>":0.0..1.0,...}},"primary":"<slug>","confidence":0.0..1.0,
+    "features":{{"<slug>":[{{"token":"...","weight":0..1}}, ...], ...}}}}, ...]}}
+""").strip()}
+
+SYSTEM_TOKENS = {"role": "system", "content":
+                 "Generate compact, code-friendly tokens for EACH requested feature from a Rust file's APIs/docs. "
+                 "For each feature, output 8–20 tokens (1–3 words). Prefer public type/function names and key terms. "
+                 "Return strict JSON: {\"features\": {\"<slug>\": [{\"token\":\"...\",\"weight\":0..1}, ...], ...}}"}
+
+def _tokens_user_prefix(features: List[Dict], candidate_slugs) -> str:
+    by_slug = {f["slug"]: f for f in features}
+    cards = [by_slug[s] for s in candidate_slugs if s in by_slug]
+    return ("FEATURES:\n" +
+            "\n".join([f"- {f['slug']}: {f['title']} — {f.get('prompt', '')}" for f in cards]) +
+            "\n\nFILE SUMMARY:\n")
+
+@functools.lru_cache(maxsize=None)
+def _tokens_user_prefix_cached(candidate_slugs: Tuple[str, ...]) -> str:
+    # Only a handful of distinct candidate sets occur per run.
+    return _tokens_user_prefix(FEATURES, candidate_slugs)
+
+def lm_score_features(features: List[Dict], file_summary: str, relpath: str, model: str = LM_MODEL) -> Optional[Dict]:
+    """Score all features for one file; None when the call or its answer failed (already logged/recorded)."""
+    prefix = SCORE_USER_PREFIX if features is FEATURES else _score_user_prefix(features)
+    user = {"role": "user", "content": prefix + file_summary}
+    payload = {"model": model, "temperature": TEMPERATURE, "messages": [SYSTEM_SCORE, user]}
 
     logger.debug("Scoring features for %s", relpath)
     data = http_json_chat(payload, phase="score_features", relpath=relpath)
     if data is None:
-        return {"scores": {}, "primary": "unknown", "confidence": 0.0}
-
-    content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-    clean = _extract_json_blob(content)
-    try:
-        return json.loads(clean)
-    except Exception as je:
-        logger.error("Content JSON parse failed (score_features) for %s | err=%s | content=%s",
-                     relpath, je, _shorten(content))
-        FAILED_CALLS.append({"phase": "score_features_content_parse", "file": relpath,
-                             "status": None, "body": _shorten(content, 1200)})
-        return {"scores": {}, "primary": "unknown", "confidence": 0.0}
+        return None
+    return _answer_scores(_content_json(data, "score_features", relpath), "score_features", relpath)
 
-def lm_tokens_for_features(features: List[Dict], candidate_slugs: List[str], file_summary: str, relpath: str) -> Dict[str, List[Dict]]:
+def lm_tokens_for_features(features: List[Dict], candidate_slugs: List[str], file_summary: str, relpath: str,
+                           model: str = LM_MODEL) -> Optional[Dict[str, List[Dict]]]:
+    """Tokens for the candidate features of one file; None when the call or its answer failed."""
     if not candidate_slugs:
         return {}
-    cards = []
-    for s in candidate_slugs:
-        f = next((x for x in features if x["slug"] == s), None)
-        if f:
-            cards.append({"slug": f["slug"], "title": f["title"], "what": f.get("prompt", "")})
-    system = {"role": "system", "content":
-              "Generate compact, code-friendly tokens for EACH requested feature from a Rust file's APIs/docs. "
-              "For each feature, output 8–20 tokens (1–3 words). Prefer public type/function names and key terms. "
-              "Return strict JSON: {\"features\": {\"<slug>\": [{\"token\":\"...\",\"weight\":0..1}, ...], ...}}"}
-    user = {"role": "user", "content": "FEATURES:\n" +
-            "\n".join([f"- {c['slug']}: {c['title']} — {c['what']}" for c in cards]) +
-            "\n\nFILE SUMMARY:\n" + file_summary}
-    payload = {"model": LM_MODEL, "temperature": 0.0, "messages": [system, user]}
+    if features is FEATURES:
+        prefix = _tokens_user_prefix_cached(tuple(candidate_slugs))
+    else:
+        prefix = _tokens_user_prefix(features, candidate_slugs)
+    user = {"role": "user", "content": prefix + file_summary}
+    payload = {"model": model, "temperature": 0.0, "messages": [SYSTEM_TOKENS, user]}
 
     logger.debug("Requesting tokens for %s | features=%s", relpath, ",".join(candidate_slugs))
     data = http_json_chat(payload, phase="tokens_for_features", relpath=relpath)
     if data is None:
-        return {}
+        return None
+    return _answer_tokens(_content_json(data, "tokens_for_features", relpath), "tokens_for_features", relpath)
+
+def lm_score_and_tokens(features: List[Dict], file_summary: str, relpath: str,
+                        model: str = LM_MODEL) -> Optional[Tuple[Dict, Dict[str, List[Dict]]]]:
+    """Score all features and emit tokens for the likely matches in ONE request.
+
+    Returns (score_response, tokens_by_feature) in the shapes produced by
+    lm_score_features and lm_tokens_for_features respectively, or None when
+    the call or its answer failed.
+    """
+    prefix = SCORE_USER_PREFIX if features is FEATURES else _score_user_prefix(features)
+    user = {"role": "user", "content": prefix + file_summary}
+    payload = {"model": model, "temperature": TEMPERATURE, "messages": [SYSTEM_SCORE_AND_TOKENS, user]}
+
+    logger.debug("Scoring features + tokens for %s", relpath)
+    data = http_json_chat(payload, phase="score_and_tokens", relpath=relpath)
+    if data is None:
+        return None
+
+    raw = _content_json(data, "score_and_tokens", relpath)
+    resp = _answer_scores(raw, "score_and_tokens", relpath)
+    toks = _answer_tokens(raw, "score_and_tokens", relpath) if resp is not None else None
+    if toks is None:
+        return None
+    return resp, toks
+
+def lm_score_batch(features: List[Dict], files: List[Tuple[str, str]],
+                   model: str = LM_MODEL) -> Optional[Dict[str, Tuple[Dict, Dict[str, List[Dict]]]]]:
+    """Score + tokenize several (relpath, summary) pairs in ONE request.
+
+    Returns {relpath: (score_response, tokens_by_feature)} for the rows the
+    model answered; callers fall back to single-file calls for missing rows.
+    Returns None when the request itself failed (already logged/recorded).
+    """
+    label = f"{len(files)} files: " + ", ".join(rel for rel, _ in files)
+    prefix = BATCH_USER_PREFIX if features is FEATURES else _features_block(features) + "FILES:\n"
+    body = "\n".join(f"[{i}] {rel}\n<<<\n{summary}\n>>>" for i, (rel, summary) in enumerate(files, 1))
+    user = {"role": "user", "content": prefix + body}
+    payload = {"model": model, "temperature": TEMPERATURE, "messages": [SYSTEM_SCORE_BATCH, user],
+               "max_tokens": LM_MAX_TOKENS * len(files)}
+
+    logger.debug("Scoring batch of %s", label)
+    data = http_json_chat(payload, phase="score_batch", relpath=label)
+    if data is None:
+        return None
+
+    return _batch_rows(_content_json(data, "score_batch", label), files)
+
+def _batch_rows(raw, files: List[Tuple[str, str]]) -> Dict[str, Tuple[Dict, Dict[str, List[Dict]]]]:
+    """Map the rows of a parsed batch answer back to their files.
+
+    Anything that is not a well-formed row (wrong shape, idx out of range, no
+    scores object or a non-numeric score, malformed features, a file already
+    answered) is skipped, so the caller retries that file on its own.
+    """
+    out: Dict[str, Tuple[Dict, Dict[str, List[Dict]]]] = {}
+    rows = raw.get("results") if isinstance(raw, dict) else None
+    if not isinstance(rows, list):
+        return out
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        try:
+            i = int(row.get("idx"))
+        except (TypeError, ValueError):
+            continue
+        if not 1 <= i <= len(files):
+            continue
+        rel = files[i - 1][0]
+        if rel in out:
+            continue
+        resp = _parse_scores(row)
+        if resp is None or len(resp["scores"]) != len(row["scores"]):
+            continue
+        feats = row.get("features")
+        toks = _normalize_feature_tokens(feats) if feats is not None else {}
+        if toks is None:
+            continue
+        out[rel] = (resp, toks)
+    return out
 
+def _content_json(data: Dict, phase: str, relpath: str) -> Optional[Dict]:
+    """Parse the JSON object out of a chat response's message content; logs and records failures."""
     content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
     clean = _extract_json_blob(content)
     try:
-        raw = json.loads(clean)
+        return load_json(clean)
     except Exception as je:
-        logger.error("Content JSON parse failed (tokens_for_features) for %s | err=%s | content=%s",
-                     relpath, je, _shorten(content))
-        FAILED_CALLS.append({"phase": "tokens_for_features_content_parse", "file": relpath,
-                             "status": None, "body": _shorten(content, 1200)})
-        return {}
+        # The first {...} may be prose (e.g. "{path}"); take the first object that parses.
+        scanner = _JsonStreamScanner()
+        if scanner.feed(content) and isinstance(scanner.result, dict):
+            return scanner.result
+        logger.error("Content JSON parse failed (%s) for %s | err=%s | content=%s",
+                     phase, relpath, je, _shorten(content))
+        _record_failure({"phase": f"{phase}_content_parse", "file": relpath,
+                         "status": None, "body": _shorten(content, 1200)})
+        return None
+
+# Parsed answers are only trusted after these checks: a well-formed JSON object
+# can still have the wrong shape (features as a list, "high" as a weight, ...),
+# and such an answer must fail like an unparseable one rather than raise later
+# in select_candidates/merge_token_index and abort the run.
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and abs(v) != float("inf") and v == v
+
+def _safe_float(v, default: float) -> float:
+    """float(v) for numbers and numeric strings, `default` for anything else."""
+    if isinstance(v, str):
+        try:
+            v = float(v)
+        except ValueError:
+            return default
+    return float(v) if _is_number(v) else default
+
+def _bad_answer(phase: str, relpath: str, raw, what: str) -> None:
+    logger.error("Content JSON has the wrong shape (%s) for %s | %s | content=%s",
+                 phase, relpath, what, _shorten(str(raw)))
+    _record_failure({"phase": f"{phase}_content_shape", "file": relpath,
+                     "status": None, "body": _shorten(str(raw), 1200)})
+
+def _parse_scores(raw) -> Optional[Dict]:
+    """{"scores", "primary", "confidence"} from an answer, or None if it has no scores object.
 
+    Non-numeric scores are dropped; a missing/odd primary becomes "unknown".
+    """
+    if not isinstance(raw, dict) or not isinstance(raw.get("scores"), dict):
+        return None
+    scores = {str(slug): float(v) for slug, v in raw["scores"].items() if _is_number(v)}
+    primary = raw.get("primary")
+    return {"scores": scores, "primary": primary if isinstance(primary, str) else "unknown",
+            "confidence": _safe_float(raw.get("confidence"), 0.0)}
+
+def _normalize_feature_tokens(raw) -> Optional[Dict[str, List[Dict]]]:
+    """{slug: [{"token", "weight"}]} from an answer's "features", or None if it is not
+    a {slug: [token, ...]} object. Tokens may be bare strings; odd weights become 0.6."""
+    if not isinstance(raw, dict):
+        return None
     out: Dict[str, List[Dict]] = {}
-    for slug, arr in raw.get("features", {}).items():
+    for slug, arr in raw.items():
+        if not isinstance(arr, list):
+            return None
         norm = []
         for t in arr:
             if isinstance(t, str):
                 norm.append({"token": t, "weight": 0.6})
             elif isinstance(t, dict):
-                norm.append({"token": str(t.get("token", "")), "weight": float(t.get("weight", 0.6))})
-        out[slug] = norm
+                norm.append({"token": str(t.get("token", "")), "weight": _safe_float(t.get("weight"), 0.6)})
+        out[str(slug)] = norm
     return out
 
+def _answer_scores(raw, phase: str, relpath: str) -> Optional[Dict]:
+    """_parse_scores for a whole answer; None (logged/recorded) when it has the wrong shape."""
+    if raw is None:
+        return None  # unparseable, already recorded by _content_json
+    resp = _parse_scores(raw)
+    if resp is None:
+        _bad_answer(phase, relpath, raw, "no scores object")
+    return resp
+
+def _answer_tokens(raw, phase: str, relpath: str) -> Optional[Dict[str, List[Dict]]]:
+    """Tokens of a whole answer ({} when it has none); None (logged/recorded) when malformed."""
+    if raw is None:
+        return None
+    if not isinstance(raw, dict):
+        _bad_answer(phase, relpath, raw, "not an object")
+        return None
+    feats = raw.get("features")
+    toks = _normalize_feature_tokens(feats) if feats is not None else {}
+    if toks is None:
+        _bad_answer(phase, relpath, raw, "features is not a {slug: [tokens]} object")
+    return toks
+
+def select_candidates(scores: Dict[str, float]) -> List[str]:
+    """Features that get tokens: every score >= SCORE_MIN, topped up to TOP_K_FALLBACK."""
+    # Only the few passing scores get sorted; the fallback is a top-K selection.
+    # Both orderings match a full descending (stable) sort of all scores.
+    above = [kv for kv in scores.items() if kv[1] >= SCORE_MIN]
+    if len(above) >= min(TOP_K_FALLBACK, len(scores)):
+        above.sort(key=lambda kv: kv[1], reverse=True)
+        return [s for s, _ in above]
+    return [s for s, _ in heapq.nlargest(TOP_K_FALLBACK, scores.items(), key=lambda kv: kv[1])]
+
+_WORD_RE = _re.compile(r"[A-Z]?[a-z]+")
+
+def keyword_classify(file_summary: str) -> Optional[Tuple[Dict, Dict[str, List[Dict]]]]:
+    """Classify a file from FEATURE_KEYWORDS hits alone, without the LLM.
+
+    Returns (scores response, tokens by feature) shaped like lm_score_and_tokens,
+    or None when the hits are too few or too spread out to be trusted.
+    """
+    # The PATH line is context the LLM is told to ignore; don't let it vote here either.
+    if file_summary.startswith(SUMMARY_PATH_PREFIX):
+        file_summary = file_summary.partition("\n")[2]
+    hits: Dict[str, Counter] = defaultdict(Counter)
+    for word in _WORD_RE.findall(file_summary):
+        word = word.lower()
+        slug = _KEYWORD_OWNER.get(word)
+        if slug is not None:
+            hits[slug][word] += 1
+    totals = {slug: sum(c.values()) for slug, c in hits.items()}
+    total = sum(totals.values())
+    if total < KEYWORD_MIN_HITS:
+        return None
+    primary = max(totals, key=totals.get)
+    confidence = totals[primary] / total
+    if confidence < KEYWORD_MIN_SHARE or len(hits[primary]) < KEYWORD_MIN_DISTINCT:
+        return None
+    scores = {slug: round(n / total, 2) for slug, n in totals.items()}
+    # The matched keywords double as the file's tokens, weighted by frequency.
+    toks_by_feat = {}
+    for slug, words in hits.items():
+        top = max(words.values())
+        toks_by_feat[slug] = [{"token": w, "weight": round(n / top, 2)} for w, n in words.most_common(12)]
+    return {"scores": scores, "primary": primary, "confidence": round(confidence, 2)}, toks_by_feat
+
 # ==========================
 # Caching
 # ==========================
 
-def load_classify_cache() -> Dict:
+class ClassifyCache:
+    """Per-file classification cache in SQLite, one row per file.
+
+    Each classified file is a single upsert instead of a rewrite of the whole
+    cache. WAL with synchronous=NORMAL keeps commits cheap while a crash still
+    loses at most the last few rows. Used from the main thread only.
+    """
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(str(path), isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS classify (rel TEXT PRIMARY KEY, entry BLOB NOT NULL)")
+
+    @property
+    def taxonomy_version(self) -> Optional[int]:
+        row = self._db.execute("SELECT v FROM meta WHERE k = 'taxonomy_version'").fetchone()
+        return int(row[0]) if row else None
+
+    @taxonomy_version.setter
+    def taxonomy_version(self, v: int):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('taxonomy_version', ?)", (str(v),))
+
+    def entries(self) -> Dict[str, Dict]:
+        return {rel: load_json(entry) for rel, entry in self._db.execute("SELECT rel, entry FROM classify")}
+
+    def upsert(self, rel: str, entry: Dict):
+        self._db.execute("INSERT OR REPLACE INTO classify VALUES (?, ?)", (rel, dump_json(entry)))
+
+    def upsert_many(self, entries: Dict[str, Dict]):
+        with self._db:  # one transaction
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO classify VALUES (?, ?)",
+                                 ((rel, dump_json(e)) for rel, e in entries.items()))
+
+    def clear(self):
+        self._db.execute("DELETE FROM classify")
+
+    def close(self):
+        self._db.close()
+
+def open_classify_cache(model: str = LM_MODEL) -> ClassifyCache:
+    """Open the SQLite cache, importing the legacy JSON cache on first use.
+
+    Legacy entries are {"sha1", "primary", "scores"} per file. They are keyed
+    as if classified by `model` (the JSON cache did not record one) and carry
+    no tokens, so each gets a tokens-only call on its first run. With xxhash
+    installed the hashes no longer match and those files are re-classified.
+    """
+    cache = ClassifyCache(CLASSIFY_DB_FILE)
     if CLASSIFY_CACHE_FILE.exists():
         try:
-            return json.loads(CLASSIFY_CACHE_FILE.read_text())
-        except Exception:
-            return {}
-    return {}
+            legacy = load_json(CLASSIFY_CACHE_FILE.read_bytes())
+            if cache.taxonomy_version is None:
+                cache.taxonomy_version = legacy.get("taxonomy_version", TAXONOMY_VERSION)
+                files = {}
+                for rel, e in (legacy.get("files") or {}).items():
+                    resp = _parse_scores(e)
+                    if resp is not None and isinstance(e.get("sha1"), str):
+                        files[rel] = {"key": cache_key(e["sha1"], model), "primary": resp["primary"],
+                                      "scores": resp["scores"]}
+                cache.upsert_many(files)
+                logger.info("Imported %d cache entries from %s", len(files), CLASSIFY_CACHE_FILE)
+            CLASSIFY_CACHE_FILE.unlink()
+        except Exception as e:
+            logger.debug("Could not import legacy cache %s: %s", CLASSIFY_CACHE_FILE, e)
+    return cache
 
-def save_classify_cache(c: Dict):
-    CLASSIFY_CACHE_FILE.write_text(json.dumps(c, indent=2, ensure_ascii=False))
+class SummaryCache:
+    """Per-file LLM summaries (keyed by content hash) in the cache DB.
+
+    Only files that go to the LLM need a summary, so they are looked up one at a
+    time instead of being loaded up front. Used from the scan workers: one
+    connection shared under a lock.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS summary (rel TEXT PRIMARY KEY, hash TEXT NOT NULL, text TEXT NOT NULL)")
+        row = self._db.execute("SELECT v FROM meta WHERE k = 'summary_version'").fetchone()
+        if row is None or int(row[0]) != SUMMARY_CACHE_VERSION:
+            self._db.execute("DELETE FROM summary")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('summary_version', ?)", (str(SUMMARY_CACHE_VERSION),))
+
+    def get(self, rel: str, file_hash: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT text FROM summary WHERE rel = ? AND hash = ?", (rel, file_hash)).fetchone()
+        return row[0] if row else None
+
+    def put(self, rel: str, file_hash: str, summary: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO summary VALUES (?, ?, ?)", (rel, file_hash, summary))
+
+    def prune(self, keep: Iterable[str]):
+        """Drop summaries of files that no longer exist."""
+        keep = set(keep)
+        with self._lock:
+            stale = [(rel,) for (rel,) in self._db.execute("SELECT rel FROM summary") if rel not in keep]
+            if stale:
+                with self._db:
+                    self._db.execute("BEGIN")
+                    self._db.executemany("DELETE FROM summary WHERE rel = ?", stale)
+
+    def close(self):
+        self._db.close()
+
+def cached_summary(rel: str, raw: bytes, file_hash: str, summaries: SummaryCache) -> str:
+    """summarize_for_llm, memoized in `summaries` by the file's content hash. Runs on a scan worker."""
+    summary = summaries.get(rel, file_hash)
+    if summary is None:
+        summary = summarize_for_llm(rel, decode_source(raw))
+        summaries.put(rel, file_hash, summary)
+    return summary
 
 # ==========================
 # Token Index (GLOBAL)
@@ -415,10 +1164,29 @@ def save_classify_cache(c: Dict):
 
 GENERIC_TOKENS = {"state","runtime","system","value","data","item","node","layout","render","function","struct","trait"}
 
+class _TokenCharFilter(dict):
+    """str.translate table keeping [a-z0-9_+-/. ] and deleting everything else.
+
+    Entries are filled lazily on first sight of a code point, so arbitrary
+    Unicode input needs no precomputed table.
+    """
+    _ALLOWED = frozenset("abcdefghijklmnopqrstuvwxyz0123456789_+-/. ")
+
+    def __missing__(self, cp: int):
+        keep = cp if chr(cp) in self._ALLOWED else None
+        self[cp] = keep
+        return keep
+
+_TOKEN_CHARS = _TokenCharFilter()
+_TOKEN_SPACES_RE = re.compile(r" {2,}")
+
 def _norm_token(t: str) -> str:
-    t = t.strip().lower()
-    t = re.sub(r"[^a-z0-9_+\-/\. ]+", "", t)
-    t = re.sub(r"\s+", " ", t)
+    # Runs once per suggested token: one C-level translate pass, and the space
+    # collapse only when there is something to collapse. Whitespace other than
+    # " " is deleted by the filter, so only runs of spaces can remain.
+    t = t.strip().lower().translate(_TOKEN_CHARS)
+    if "  " in t:
+        t = _TOKEN_SPACES_RE.sub(" ", t)
     return t[:64]
 
 def _valid_token(tok: str) -> bool:
@@ -428,183 +1196,479 @@ def _valid_token(tok: str) -> bool:
         return False
     return True
 
+# In-memory token DB: flat per-token aggregates keyed by feature slug.
+#   counts[tok][slug] -> merges, wsum[tok][slug] -> summed weights, examples[tok] -> up to 6 paths
+# Aggregates loaded from the flat on-disk map carry no feature, so they live
+# under the "" slug: they count towards global totals but never towards a feature.
+UNATTRIBUTED = ""
+
+def new_tokens_db(taxonomy_version=None, model=None) -> Dict:
+    return {"taxonomy_version": taxonomy_version, "model": model,
+            "counts": defaultdict(Counter), "wsum": defaultdict(lambda: defaultdict(float)),
+            "examples": defaultdict(list)}
+
 def load_tokens_db() -> Dict:
     if TOKENS_DB_FILE.exists():
         try:
-            raw = json.loads(TOKENS_DB_FILE.read_text())
-            # If file already contains the internal token_index, return it
-            if isinstance(raw, dict) and raw.get("token_index"):
-                return raw
+            raw = load_json(TOKENS_DB_FILE.read_bytes())
+            if not isinstance(raw, dict):
+                raise ValueError("unexpected token DB shape")
+            db = new_tokens_db(raw.get("taxonomy_version"), raw.get("model"))
+            counts, wsum, examples = db["counts"], db["wsum"], db["examples"]
+
+            # Nested internal token_index (written by older versions on save failure).
+            if raw.get("token_index"):
+                for tok, meta in raw["token_index"].items():
+                    for slug, fe in (meta.get("by_feature") or {}).items():
+                        counts[tok][slug] += fe.get("count", 0)
+                        wsum[tok][slug] += fe.get("weight_sum", 0.0)
+                    g = meta.get("global") or {}
+                    rest = g.get("count", 0) - sum(counts[tok].values())
+                    if rest > 0:
+                        counts[tok][UNATTRIBUTED] += rest
+                        wsum[tok][UNATTRIBUTED] += max(0.0, g.get("weight_sum", 0.0) - sum(wsum[tok].values()))
+                    if g.get("examples"):
+                        examples[tok] = list(g["examples"])
+                return db
 
             # If this is the old 'features' -> {slug: {tokens: [...]}} format, convert.
-            if isinstance(raw, dict) and raw.get("features"):
-                db = {"taxonomy_version": raw.get("taxonomy_version"), "model": raw.get("model"), "token_index": {}}
+            if raw.get("features"):
                 for slug, meta in (raw.get("features") or {}).items():
-                    toks = meta.get("tokens") or []
-                    for t in toks:
+                    for t in meta.get("tokens") or []:
                         tok = _norm_token(t)
                         if not _valid_token(tok):
                             continue
-                        ent = db["token_index"].setdefault(tok, {
-                            "global": {"count": 0, "weight_sum": 0.0, "examples": [], "last_seen": 0},
-                            "by_feature": {}
-                        })
-                        ent["global"]["count"] += 1
-                        ent["global"]["weight_sum"] += 1.0
-                        fe = ent["by_feature"].setdefault(slug, {"count": 0, "weight_sum": 0.0})
-                        fe["count"] += 1
-                        fe["weight_sum"] += 1.0
+                        counts[tok][slug] += 1
+                        wsum[tok][slug] += 1.0
                 return db
 
             # If this is the flat token -> [paths] map (with optional taxonomy_version/model),
-            # convert to internal token_index. Detect by presence of string keys mapping to lists
-            # excluding known meta keys.
-            if isinstance(raw, dict):
-                known = {"taxonomy_version", "model"}
-                token_keys = [k for k, v in raw.items() if k not in known and isinstance(v, list)]
-                if token_keys:
-                    db = {"taxonomy_version": raw.get("taxonomy_version"), "model": raw.get("model"), "token_index": {}}
-                    now = int(time.time())
-                    for tok in token_keys:
-                        norm = _norm_token(tok)
-                        if not _valid_token(norm):
-                            continue
-                        paths = raw.get(tok) or []
-                        ent = db["token_index"].setdefault(norm, {
-                            "global": {"count": 0, "weight_sum": 0.0, "examples": [], "last_seen": 0},
-                            "by_feature": {}
-                        })
-                        ent["global"]["count"] = len(paths)
-                        ent["global"]["weight_sum"] = float(len(paths))
-                        ent["global"]["examples"] = list(dict.fromkeys(paths))[:6]
-                        ent["global"]["last_seen"] = now
-                    return db
+            # convert. Detect by presence of string keys mapping to lists excluding known meta keys.
+            known = {"taxonomy_version", "model"}
+            for tok, paths in raw.items():
+                if tok in known or not isinstance(paths, list):
+                    continue
+                norm = _norm_token(tok)
+                if not _valid_token(norm):
+                    continue
+                paths = paths or []
+                counts[norm][UNATTRIBUTED] = len(paths)
+                wsum[norm][UNATTRIBUTED] = float(len(paths))
+                examples[norm] = list(dict.fromkeys(paths))[:6]
+            return db
         except Exception:
             pass
-    return {"taxonomy_version": None, "model": None, "token_index": {}}
+    return new_tokens_db()
 
 def save_tokens_db(db: Dict):
     OUT_DIR.mkdir(parents=True, exist_ok=True)
     # Produce a flat token -> [paths] map (plus taxonomy_version and model keys)
-    try:
-        idx = db.get("token_index", {})
-        token_map = {}
-        for tok, meta in idx.items():
-            examples = meta.get("global", {}).get("examples", [])
-            if examples:
-                token_map[tok] = list(dict.fromkeys(examples))
-
-        out = {"taxonomy_version": db.get("taxonomy_version"), "model": db.get("model")}
-        out.update(token_map)
-        TOKENS_DB_FILE.write_text(json.dumps(out, indent=2, ensure_ascii=False))
-    except Exception:
-        TOKENS_DB_FILE.write_text(json.dumps(db, indent=2, ensure_ascii=False))
+    out = {"taxonomy_version": db.get("taxonomy_version"), "model": db.get("model")}
+    for tok, examples in db["examples"].items():
+        if examples:
+            out[tok] = list(dict.fromkeys(examples))
+    write_atomic(TOKENS_DB_FILE, dump_json(out))
 
 def merge_token_index(db: Dict, taxonomy_version: int, model_name: str,
                       slug: str, file_path: str, suggestions: List[Dict]):
     db["taxonomy_version"] = taxonomy_version
     db["model"] = model_name
-    idx = db.setdefault("token_index", {})
-    now = int(time.time())
+    counts, wsum, examples = db["counts"], db["wsum"], db["examples"]
     for s in suggestions:
         tok = _norm_token(s.get("token", ""))
-        w = float(s.get("weight", 0.6))
         if not _valid_token(tok):
             continue
-        ent = idx.setdefault(tok, {
-            "global": {"count": 0, "weight_sum": 0.0, "examples": [], "last_seen": 0},
-            "by_feature": {}
-        })
-        ent["global"]["count"] += 1
-        ent["global"]["weight_sum"] += w
-        ent["global"]["last_seen"] = now
-        if len(ent["global"]["examples"]) < 6 and file_path not in ent["global"]["examples"]:
-            ent["global"]["examples"].append(file_path)
-        fe = ent["by_feature"].setdefault(slug, {"count": 0, "weight_sum": 0.0})
-        fe["count"] += 1
-        fe["weight_sum"] += w
-
-def top_tokens_for_feature(db: Dict, slug: str, k: int = 32) -> List[str]:
-    idx = db.get("token_index", {})
-    scored = []
-    for tok, meta in idx.items():
-        if slug not in meta.get("by_feature", {}):
-            continue
-        fe = meta["by_feature"][slug]
-        avg_w = fe["weight_sum"] / max(1, fe["count"])
-        score = fe["count"] * (0.5 + 0.5 * avg_w)
-        scored.append((score, tok))
-    scored.sort(reverse=True)
-    return [tok for _, tok in scored[:k]]
+        counts[tok][slug] += 1
+        wsum[tok][slug] += float(s.get("weight", 0.6))
+        ex = examples[tok]
+        if len(ex) < 6 and file_path not in ex:
+            ex.append(file_path)
+
+class Persistor:
+    """Writes progress snapshots (the feature map) on a background thread.
+
+    The merge loop only calls mark_dirty(); marks are coalesced into one write
+    per SAVE_PROGRESS_EVERY marks or PERSIST_INTERVAL_SEC. `snapshot` runs with
+    `lock` held (the merge loop holds it while mutating the same state) and
+    returns the (path, bytes) pairs to write; the writes happen outside the lock.
+    Pending marks are dropped on close(): main saves the final state itself.
+    """
+
+    def __init__(self, snapshot: Callable[[], List[Tuple[Path, bytes]]], lock: threading.Lock,
+                 every: int = SAVE_PROGRESS_EVERY, interval: float = PERSIST_INTERVAL_SEC):
+        self._snapshot = snapshot
+        self._lock = lock
+        self._every = every
+        self._interval = interval
+        self._cond = threading.Condition()
+        self._dirty = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="persistor", daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self):
+        with self._cond:
+            self._dirty += 1
+            if self._dirty >= self._every:
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._closed:
+                    self._cond.wait()
+                # Coalesce further marks until enough pile up or the interval runs out.
+                deadline = time.monotonic() + self._interval
+                while self._dirty < self._every and not self._closed:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                if self._closed:
+                    return
+                n, self._dirty = self._dirty, 0
+            try:
+                with self._lock:
+                    blobs = self._snapshot()
+                for path, data in blobs:
+                    write_atomic(path, data)
+                logger.info("saved progress (%d more files) to: %s", n, OUT_DIR)
+            except Exception as e:
+                logger.debug("failed to save progress: %s", e)
+
+def top_tokens_by_feature(db: Dict, k: int = 32) -> Dict[str, List[str]]:
+    """Top-k tokens of every feature, scored count * (0.5 + 0.5 * avg weight).
+
+    One pass over the index fills all slugs at once and each slug only pays a
+    partial sort, instead of a full index scan plus full sort per feature."""
+    scored: Dict[str, List[Tuple[float, str]]] = defaultdict(list)
+    wsum = db["wsum"]
+    for tok, by_slug in db["counts"].items():
+        tok_wsum = wsum[tok]
+        for slug, count in by_slug.items():
+            if slug == UNATTRIBUTED or not count:
+                continue
+            avg_w = tok_wsum[slug] / count
+            scored[slug].append((count * (0.5 + 0.5 * avg_w), tok))
+    # nlargest orders exactly like sort(reverse=True)[:k], ties included.
+    return {slug: [tok for _, tok in heapq.nlargest(k, rows)] for slug, rows in scored.items()}
 
 def tokens_global_sorted(db: Dict) -> List[Tuple[str, Dict]]:
-    idx = db.get("token_index", {})
+    """All tokens with their global (all-feature) aggregates, best first."""
+    rows = []
+    for tok, by_slug in db["counts"].items():
+        count = sum(by_slug.values())
+        weight_sum = sum(db["wsum"][tok].values())
+        rows.append((tok, {"count": count, "weight_sum": weight_sum, "examples": db["examples"].get(tok, [])}))
     def gscore(meta):
-        g = meta["global"]
-        avg = g["weight_sum"] / max(1, g["count"])
-        return g["count"] * (0.5 + 0.5 * avg)
-    return sorted(idx.items(), key=lambda kv: gscore(kv[1]), reverse=True)
+        avg = meta["weight_sum"] / max(1, meta["count"])
+        return meta["count"] * (0.5 + 0.5 * avg)
+    return sorted(rows, key=lambda kv: gscore(kv[1]), reverse=True)
 
 # ==========================
 # Generation (docs)
 # ==========================
 
+def feature_map_json(feature_map: Dict) -> bytes:
+    # A slim feature map: slug -> sorted list of files (no titles, no nesting)
+    slim = {slug: sorted(meta.get("include", ())) for slug, meta in feature_map.items()}
+    return dump_json({"taxonomy_version": TAXONOMY_VERSION, "features": slim})
+
 def write_feature_map_json(feature_map: Dict):
     OUT_DIR.mkdir(parents=True, exist_ok=True)
-    # Write a slim feature map: slug -> list of files (no titles, no nesting)
-    slim = {slug: meta.get("include", []) for slug, meta in feature_map.items()}
-    (OUT_DIR / "feature_map.json").write_text(
-        json.dumps({"taxonomy_version": TAXONOMY_VERSION, "features": slim}, indent=2),
-        encoding="utf-8"
-    )
+    write_atomic(FEATURE_MAP_FILE, feature_map_json(feature_map))
 
 def write_tokens_md(tokens_db: Dict):
     # TOKENS.md generation disabled per user request (no op)
     return
 
-def write_feature_docs(feature_map: Dict, file_code_map: Dict[str, str], tokens_db: Dict):
-    for slug, meta in feature_map.items():
-        paths = sorted(set(meta.get("include", [])))
+def write_feature_docs(feature_map: Dict, file_paths: Dict[str, str], tokens_db: Dict):
+    # Files shared by several features are read and parsed once, not once per
+    # feature, one file at a time. Sources stay undecoded: public items are matched
+    # on bytes (they are ASCII), and only the head that extract_leading_docs can
+    # reach is decoded.
+    def parse_one(rel: str) -> Tuple[str, Dict]:
+        path = file_paths.get(rel)
+        try:
+            raw = read_bytes(path) if path else b""
+        except OSError:
+            raw = b""  # deleted since it was scanned
+        apis = [m.decode("ascii") for m in PUB_ITEM_RE_BYTES.findall(raw)]
+        lead = extract_leading_docs(decode_head(raw, 80 + 20), max_lines=80)
+        return rel, {"lead": lead, "items": apis[:12], "apis": apis}
+
+    def write_one(item: Tuple[str, Dict]):
+        slug, meta = item
+        paths = sorted(meta.get("include", ()))
         if not paths:
-            continue
-        title = FEATURE_TITLES.get(slug, slug)
-        parts = [f"# {title}\n", f"> Purpose: {title}.\n", "## Primary APIs\n"]
-        apis = []
-        for p in paths:
-            code = file_code_map.get(p, "")
-            apis.extend(m for m in PUB_ITEM_RE.findall(code))
-        apis = sorted(set(apis))[:120]
-        parts += [*(f"- `{a}`" for a in apis)] or ["- _(none)_"]
-
-        parts.append("\n## Discovered tokens (aggregated)\n")
-        tokens = top_tokens_for_feature(tokens_db, slug, k=32)
-        if tokens:
-            parts += [*(f"- `{t}`" for t in tokens)]
-        else:
-            parts.append("- _(none yet)_")
-
-        parts.append("\n## How it works\n<!-- @editable:start -->\n<!-- add notes -->\n<!-- @editable:end -->\n")
-        parts.append("## Source Files (excerpts)\n")
-        for p in paths:
-            code = file_code_map.get(p, "")
-            lead = extract_leading_docs(code, max_lines=80)
-            items = extract_public_items(code, limit=12)
-            parts.append(f"### {p}\n")
-            if items:
-                parts.append("**Public APIs (subset):**")
-                for it in items:
-                    parts.append(f"- `{it}`")
-                parts.append("")
-            parts.append("```rust")
-            parts.append(lead.rstrip())
-            parts.append("```")
-            parts.append("")
-        (OUT_DIR / f"all_about_{slug}.md").write_text("\n".join(parts), encoding="utf-8")
+            return
+        # Encode line by line into one buffer instead of joining a big str first.
+        buf = bytearray()
+        for i, line in enumerate(_feature_doc_lines(slug, paths, precomp, top_tokens.get(slug, []))):
+            if i:
+                buf += b"\n"
+            buf += line.encode("utf-8")
+        (OUT_DIR / f"all_about_{slug}.md").write_bytes(buf)
+
+    top_tokens = top_tokens_by_feature(tokens_db, k=32)
+
+    # One file per feature and only read-only shared state, so no locking needed.
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        included = {p for meta in feature_map.values() for p in meta.get("include", ())}
+        precomp: Dict[str, Dict] = dict(ex.map(parse_one, included))
+        list(ex.map(write_one, feature_map.items()))  # list() re-raises worker errors
+
+def _feature_doc_lines(slug: str, paths: List[str], precomp: Dict[str, Dict], tokens: List[str]) -> Iterator[str]:
+    title = FEATURE_TITLES.get(slug, slug)
+    yield from (f"# {title}\n", f"> Purpose: {title}.\n", "## Primary APIs\n")
+    apis = []
+    for p in paths:
+        apis.extend(precomp[p]["apis"])
+    apis = sorted(set(apis))[:120]
+    yield from [*(f"- `{a}`" for a in apis)] or ["- _(none)_"]
+
+    yield "\n## Discovered tokens (aggregated)\n"
+    if tokens:
+        yield from (f"- `{t}`" for t in tokens)
+    else:
+        yield "- _(none yet)_"
+
+    yield "\n## How it works\n<!-- @editable:start -->\n<!-- add notes -->\n<!-- @editable:end -->\n"
+    yield "## Source Files (excerpts)\n"
+    for p in paths:
+        lead = precomp[p]["lead"]
+        items = precomp[p]["items"]
+        yield f"### {p}\n"
+        if items:
+            yield "**Public APIs (subset):**"
+            for it in items:
+                yield f"- `{it}`"
+            yield ""
+        yield "```rust"
+        yield lead.rstrip()
+        yield "```"
+        yield ""
 
 def write_index(feature_map: Dict, tokens_db: Dict):
     # README.md/index generation disabled per user request (no op)
     return
 
+# ==========================
+# Per-file pipeline
+# ==========================
+
+def _reusable(ctx: RunCtx, entry: Optional[Dict], key: str) -> bool:
+    """Whether a cache entry answers for content `key` in this run.
+
+    Keyword fast-path entries only count while the fast path is on and was
+    built from the current keyword table; otherwise the file goes to the LLM.
+    """
+    if not entry or entry.get("key") != key:
+        return False
+    tag = entry.get("keywords")
+    return tag is None or (ctx.keyword_fast_path and tag == KEYWORD_TABLE_VERSION)
+
+def scan_file(ctx: RunCtx, idx: int, path: str, rel: str, cached: Optional[Dict],
+              cached_by_key: Dict[str, Dict], summaries: SummaryCache) -> Dict:
+    """Read and hash one file and resolve it from the cache when possible. Runs on a worker thread.
+
+    Returns a finished result (see _file_result) on a cache hit, otherwise a
+    pending job carrying the LLM summary for classify_batch. A file whose own
+    entry is stale but whose exact content is cached under another path (a
+    copied or moved file) is a hit too: cached_by_key maps cache key -> entry.
+    """
+    total = ctx.total_files
+    _PROGRESS.label = f"[{idx}/{total}] "
+    logger.info("Processing file %d/%d: %s", idx, total, rel)
+    # Hash the raw bytes; the source is only decoded if an LLM call needs it and
+    # no summary of this exact content is cached.
+    raw = read_bytes(path)
+    file_hash = content_hash(raw)
+    key = cache_key(file_hash, ctx.lm_model)
+
+    # Cache entries carry the tokens too, so an unchanged file needs no LLM call.
+    # Entries written before tokens were cached still get a tokens-only call.
+    entry = None
+    if not _reusable(ctx, cached, key):
+        cached = cached_by_key.get(key)
+        if not _reusable(ctx, cached, key):
+            cached = None
+        entry = cached  # same content as another file: store it for this path too
+    if cached:
+        if cached.get("no_candidates"):
+            # Nothing to select or tokenize (e.g. the LLM gave no scores): done.
+            return _file_result(ctx, idx, rel, path, entry, cached["primary"], [], {})
+        primary = cached["primary"]
+        toks_by_feat = cached.get("tokens")
+        candidates = select_candidates(cached["scores"])
+        logger.debug("[%d/%d] reuse cache: %s → %s", idx, total, rel, primary)
+        if toks_by_feat is None and candidates:
+            summary = cached_summary(rel, raw, file_hash, summaries)
+            toks_by_feat = lm_tokens_for_features(FEATURES, candidates, summary, rel, ctx.lm_model)
+            if toks_by_feat is not None:  # on failure keep the entry as is and ask again next run
+                entry = {**cached, "tokens": toks_by_feat}
+        return _file_result(ctx, idx, rel, path, entry, primary, candidates, toks_by_feat or {})
+
+    summary = cached_summary(rel, raw, file_hash, summaries)
+    fast = keyword_classify(summary) if ctx.keyword_fast_path else None
+    if fast is not None:
+        logger.debug("[%d/%d] keyword fast path: %s", idx, total, rel)
+        return _classified_result(ctx, idx, rel, path, key, *fast, keywords=True)
+    return {"pending": True, "idx": idx, "rel": rel, "path": path, "key": key, "summary": summary}
+
+def prefetch_scans(jobs: Iterable[Tuple], depth: int) -> Iterator[Dict]:
+    """Yield scan_file results in order while background threads read ahead.
+
+    Up to SCAN_WORKERS files are scanned in parallel and the producer stays at
+    most `depth` files ahead, so file IO, hashing and summarizing overlap with
+    each other and with the LLM requests already in flight.
+    """
+    q: "queue.Queue" = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            with ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix="scan") as pool:
+                window: "deque" = deque()
+                for job in jobs:
+                    window.append(pool.submit(scan_file, *job))
+                    if len(window) >= depth:
+                        q.put(window.popleft().result())
+                while window:
+                    q.put(window.popleft().result())
+        except BaseException as e:  # re-raised on the consumer side
+            q.put(e)
+            return
+        q.put(done)
+
+    threading.Thread(target=producer, name="prefetch", daemon=True).start()
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+def iter_batches(pending: Iterable[Dict], max_files: int = SCORE_BATCH_SIZE) -> Iterator[List[Dict]]:
+    """Group pending jobs (in order) into micro-batches within the size/token limits.
+
+    A batch is yielded as soon as the next job would not fit, so callers can
+    submit it while later files are still being scanned.
+    """
+    cur: List[Dict] = []
+    cur_tokens = 0
+    for job in pending:
+        n = count_tokens(job["summary"])
+        if cur and (len(cur) >= max_files or cur_tokens + n > SCORE_BATCH_TOKENS):
+            yield cur
+            cur, cur_tokens = [], 0
+        cur.append(job)
+        cur_tokens += n
+    if cur:
+        yield cur
+
+def classify_batch(ctx: RunCtx, batch: List[Dict]) -> List[Dict]:
+    """Score + tokenize a batch of pending jobs. Runs on a worker thread.
+
+    Batches of several files go out as one request; any file the batch answer
+    does not cover (unparseable JSON, missing row) is retried on its own.
+    """
+    total, model = ctx.total_files, ctx.lm_model
+    rows: Dict[str, Tuple[Dict, Dict[str, List[Dict]]]] = {}
+    batch_failed = False
+    if len(batch) > 1:
+        _PROGRESS.label = f"[{batch[0]['idx']}..{batch[-1]['idx']}/{total}] "
+        got = lm_score_batch(FEATURES, [(job["rel"], job["summary"]) for job in batch], model)
+        batch_failed = got is None
+        rows = got or {}
+
+    results = []
+    for job in batch:
+        idx, rel = job["idx"], job["rel"]
+        _PROGRESS.label = f"[{idx}/{total}] "
+        answer: Optional[Tuple[Dict, Dict[str, List[Dict]]]] = None
+        if rel in rows:
+            answer = rows[rel]
+        elif batch_failed:
+            pass  # the server did not answer the batch; don't hammer it file by file
+        elif ctx.two_call:
+            logger.debug("[%d/%d] scoring, then tokens: %s", idx, total, rel)
+            resp = lm_score_features(FEATURES, job["summary"], rel, model)
+            if resp is not None:
+                candidates = select_candidates(resp["scores"])
+                toks_by_feat = lm_tokens_for_features(FEATURES, candidates, job["summary"], rel, model)
+                answer = (resp, toks_by_feat) if toks_by_feat is not None else None
+        else:
+            logger.debug("[%d/%d] scoring + tokens: %s", idx, total, rel)
+            answer = lm_score_and_tokens(FEATURES, job["summary"], rel, model)
+        if answer is None:
+            results.append(_failed_result(ctx, idx, rel, job["path"], job["key"]))
+        else:
+            results.append(_classified_result(ctx, idx, rel, job["path"], job["key"], *answer))
+    return results
+
+def _classified_result(ctx: RunCtx, idx: int, rel: str, path: str, key: str, resp: Dict,
+                       toks_by_feat: Dict[str, List[Dict]], keywords: bool = False) -> Dict:
+    primary = resp.get("primary", "unknown")
+    scores  = resp.get("scores", {})
+    # Keep tokens only for the features this file is actually assigned to.
+    candidates = select_candidates(scores)
+    toks_by_feat = {slug: toks for slug, toks in toks_by_feat.items() if slug in candidates}
+    entry = {"key": key, "primary": primary, "scores": scores, "tokens": toks_by_feat}
+    if not candidates:
+        entry["no_candidates"] = True  # a real answer without usable scores: nothing to ask again
+    if keywords:
+        entry["keywords"] = KEYWORD_TABLE_VERSION  # keyword fast path, not the LLM
+    logger.info("[%d/%d] primary=%s | %s", idx, ctx.total_files, primary, rel)
+    return dict(_file_result(ctx, idx, rel, path, entry, primary, candidates, toks_by_feat), key=key)
+
+def _failed_result(ctx: RunCtx, idx: int, rel: str, path: str, key: str) -> Dict:
+    """Result for a file the LLM did not classify (call failed or answer unusable).
+
+    The file shows up as "unknown" in this run's docs, but nothing is cached
+    (entry None), so the next run asks again.
+    """
+    logger.warning("[%d/%d] not classified (LLM call failed), will retry next run | %s", idx, ctx.total_files, rel)
+    return dict(_file_result(ctx, idx, rel, path, None, "unknown", [], {}), key=key)
+
+def _duplicate_result(ctx: RunCtx, job: Dict, first: Dict) -> Dict:
+    """Result for a pending job whose content was already classified this run as `first`."""
+    logger.info("[%d/%d] same content as %s | %s", job["idx"], ctx.total_files, first["rel"], job["rel"])
+    return _file_result(ctx, job["idx"], job["rel"], job["path"], first["entry"], first["primary"],
+                        first["candidates"], first["toks_by_feat"])
+
+def _file_result(ctx: RunCtx, idx: int, rel: str, path: str, entry: Optional[Dict], primary: str,
+                 candidates: List[str], toks_by_feat: Dict[str, List[Dict]]) -> Dict:
+    # Show generated tokens immediately in progress logs (limit to first 12); the
+    # preview is only built when INFO records are actually emitted.
+    for slug, toks in toks_by_feat.items() if logger.isEnabledFor(logging.INFO) else ():
+        try:
+            preview = []
+            for t in (toks or [])[:12]:
+                if isinstance(t, dict):
+                    tok = str(t.get("token", "")).strip()
+                    w = float(t.get("weight", 0.0))
+                    preview.append("%s(%.2f)" % (tok, w))
+                else:
+                    preview.append(str(t).strip())
+            logger.info("[%d/%d] tokens -> %s: %s", idx, ctx.total_files, slug, ", ".join(preview) or "(none)")
+        except Exception as e:
+            logger.debug("[%d/%d] tokens preview failed for %s: %s", idx, ctx.total_files, slug, e)
+    if not candidates:
+        logger.debug("No candidate features above threshold for %s", rel)
+
+    # Carries the path, not the bytes: sources are re-read when the docs are written,
+    # so the run never holds the whole repo in memory.
+    return {"idx": idx, "rel": rel, "path": path, "entry": entry, "primary": primary,
+            "candidates": candidates, "toks_by_feat": toks_by_feat}
+
 # ==========================
 # Main
 # ==========================
@@ -616,19 +1680,30 @@ def main():
     import argparse
     ap = argparse.ArgumentParser(description="Generate feature docs with local LLM")
     ap.add_argument("--no-cache", action="store_true", help="Ignore classification cache and force LLM calls")
+    ap.add_argument("--no-keywords", action="store_true",
+                    help="Skip the keyword fast path and re-classify files it answered earlier with the LLM")
+    ap.add_argument("--two-call", action="store_true",
+                    help="Score and extract tokens in two separate requests per file (for models that can't follow the combined JSON schema)")
+    ap.add_argument("--concurrency", type=int, metavar="N",
+                    help=f"Max in-flight LLM requests (default {LM_CONCURRENCY})")
+    ap.add_argument("--batch-size", type=int, metavar="M",
+                    help=f"Max files per LLM request for changed files (default {SCORE_BATCH_SIZE}; 1 disables batching)")
     ap.add_argument("--run-tests", action="store_true", help="Run `cargo test` after generation (opt-in). Tests are skipped by default.")
     args = ap.parse_args()
+    concurrency = max(1, args.concurrency) if args.concurrency else LM_CONCURRENCY
+    if concurrency != LM_CONCURRENCY:
+        _mount_session_pool(concurrency)
 
     # Probe the server for available models and pick the first if our model isn't found
+    model = LM_MODEL
     try:
         found = probe_available_model()
         if found:
             logger.info("Model probe: first available model -> %s", found)
             # If our configured model isn't exactly the probed one, switch to the probed model
-            if LM_MODEL != found:
-                logger.info("Switching LM_MODEL from %s to %s (probe)", LM_MODEL, found)
-                # mutate the global
-                globals()["LM_MODEL"] = found
+            if model != found:
+                logger.info("Switching LM_MODEL from %s to %s (probe)", model, found)
+                model = found
     except Exception:
         pass
 
@@ -639,110 +1714,126 @@ def main():
         return
 
     # Load caches/DB
-    classify_cache = load_classify_cache()
-    classify_cache.setdefault("taxonomy_version", TAXONOMY_VERSION)
-    classify_cache.setdefault("files", {})
+    classify_cache = open_classify_cache(model)
     if args.no_cache:
         logger.info("--no-cache: clearing classification cache and tokens DB; forcing LLM calls")
-        classify_cache = {"taxonomy_version": TAXONOMY_VERSION, "files": {}}
-        try:
-            if CLASSIFY_CACHE_FILE.exists():
-                CLASSIFY_CACHE_FILE.unlink()
-        except Exception:
-            pass
+        classify_cache.clear()
 
-    if classify_cache["taxonomy_version"] != TAXONOMY_VERSION:
-        classify_cache["files"] = {}
-        classify_cache["taxonomy_version"] = TAXONOMY_VERSION
-        logger.info("Taxonomy version changed → invalidated classification cache.")
+    if classify_cache.taxonomy_version != TAXONOMY_VERSION:
+        if classify_cache.taxonomy_version is not None:
+            classify_cache.clear()
+            logger.info("Taxonomy version changed → invalidated classification cache.")
+        classify_cache.taxonomy_version = TAXONOMY_VERSION
+    cached_entries = classify_cache.entries()
+    cached_by_key = {e["key"]: e for e in cached_entries.values() if "key" in e}
 
     tokens_db = load_tokens_db()
+    summaries = SummaryCache(CLASSIFY_DB_FILE)
 
     # Initialize feature map (for primary assignments)
-    feature_map: Dict[str, Dict] = {f["slug"]: {"title": f["title"], "include": []} for f in FEATURES}
-    feature_map.setdefault("unknown", {"title": "Unclassified", "include": []})
-
-    file_code_map: Dict[str, str] = {}
-
-    # Process each file
-    global TOTAL_FILES, CURRENT_FILE_IDX
-    TOTAL_FILES = len(rs_files)
-    for idx, path in enumerate(rs_files, 1):
-        CURRENT_FILE_IDX = idx
-        logger.info("Processing file %d/%d: %s", idx, TOTAL_FILES, str(path.relative_to(ROOT)))
-        rel = str(path.relative_to(ROOT))
-        code = read_text(path)
-        file_code_map[rel] = code
-        file_hash = sha1_bytes(code.encode("utf-8"))
-
-        cached = classify_cache["files"].get(rel)
-        if cached and cached.get("sha1") == file_hash:
-            primary = cached["primary"]
-            scores = cached["scores"]
-            logger.debug("[%d/%d] reuse cache: %s → %s", idx, len(rs_files), rel, primary)
-        else:
-            summary = summarize_for_llm(rel, code)
-            logger.debug("[%d/%d] scoring: %s", idx, len(rs_files), rel)
-            resp = lm_score_features(FEATURES, summary, rel)
-            primary = resp.get("primary", "unknown")
-            scores  = resp.get("scores", {})
-            classify_cache["files"][rel] = {"sha1": file_hash, "primary": primary, "scores": scores}
-            logger.info("[%d/%d] primary=%s | %s", idx, len(rs_files), primary, rel)
-
-        # Candidate features for token emission (primary or not)
-        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
-        candidates = [s for s, v in ranked if v >= SCORE_MIN]
-        if len(candidates) < min(TOP_K_FALLBACK, len(ranked)):
-            candidates = [s for s, _ in ranked[:TOP_K_FALLBACK]]
-
-        # Assign file to all matching features (allow shared files). If no candidates
-        # were selected, fall back to assigning to the primary feature.
-        if candidates:
-            for s in candidates:
-                feature_map.setdefault(s, {"title": s, "include": []})
-                if rel not in feature_map[s]["include"]:
-                    feature_map[s]["include"].append(rel)
-        else:
-            feature_map.setdefault(primary, {"title": primary, "include": []})
-            if rel not in feature_map[primary]["include"]:
-                feature_map[primary]["include"].append(rel)
-
-        # Generate tokens for ALL candidate features
-        if candidates:
-            summary = summarize_for_llm(rel, code)
-            toks_by_feat = lm_tokens_for_features(FEATURES, candidates, summary, rel)
-            for slug, toks in toks_by_feat.items():
-                merge_token_index(tokens_db, TAXONOMY_VERSION, LM_MODEL, slug, rel, toks)
-                # Show generated tokens immediately in progress logs (limit to first 12)
-                try:
-                    preview = []
-                    for t in (toks or [])[:12]:
-                        if isinstance(t, dict):
-                            tok = str(t.get("token", "")).strip()
-                            w = float(t.get("weight", 0.0))
-                            preview.append(f"{tok}({w:.2f})")
-                        else:
-                            preview.append(str(t).strip())
-                    logger.info("[%d/%d] tokens -> %s: %s", idx, TOTAL_FILES, slug, ", ".join(preview) or "(none)")
-                except Exception as e:
-                    logger.debug("[%d/%d] tokens preview failed for %s: %s", idx, TOTAL_FILES, slug, e)
-        else:
-            logger.debug("No candidate features above threshold for %s", rel)
-
-        # Persist incremental progress after each file so partial results are available on-disk.
-        try:
-            save_classify_cache(classify_cache)
-            save_tokens_db(tokens_db)
-            write_feature_map_json(feature_map)
-            logger.info("[%d/%d] saved progress to: %s", idx, TOTAL_FILES, OUT_DIR)
-        except Exception as e:
-            logger.debug("[%d/%d] failed to save progress for %s: %s", idx, TOTAL_FILES, rel, e)
-
-    # Persist artifacts
-    save_classify_cache(classify_cache)
+    # "include" holds a set of rel paths; writers sort it when serializing.
+    feature_map: Dict[str, Dict] = {f["slug"]: {"title": f["title"], "include": set()} for f in FEATURES}
+    feature_map.setdefault("unknown", {"title": "Unclassified", "include": set()})
+
+    file_paths: Dict[str, str] = {}  # rel -> absolute path of every scanned file
+
+    # A prefetch thread reads/hashes/summarizes files ahead of this loop; cache
+    # hits are merged right away and misses are grouped into micro-batches that
+    # go to the LLM pool as soon as they fill. Results are merged back on this
+    # thread, so the caches/token DB/feature map keep a single writer.
+    ctx = RunCtx(lm_model=model, total_files=len(rs_files), two_call=args.two_call,
+                 concurrency=concurrency,
+                 batch_size=max(1, args.batch_size) if args.batch_size else SCORE_BATCH_SIZE,
+                 keyword_fast_path=KEYWORD_FAST_PATH and not (args.no_cache or args.no_keywords))
+    jobs = []
+    for idx, (path, rel) in enumerate(rs_files, 1):
+        jobs.append((ctx, idx, path, rel, cached_entries.get(rel), cached_by_key, summaries))
+
+    # Classify entries are upserted into SQLite as they merge and the feature map
+    # reaches disk through the Persistor's background writes. Token merges stay in
+    # memory and the full token DB is written once below; an interrupted run
+    # loses nothing, since every cached file re-merges its tokens on the next one.
+    state_lock = threading.Lock()
+    persistor = Persistor(lambda: [(FEATURE_MAP_FILE, feature_map_json(feature_map))],
+                          state_lock)
+
+    def merge_result(res: Dict):
+        rel = res["rel"]
+        file_paths[rel] = res["path"]
+        if res["entry"] is not None:
+            classify_cache.upsert(rel, res["entry"])
+        with state_lock:
+            # Assign file to all matching features (allow shared files). If no candidates
+            # were selected, fall back to assigning to the primary feature.
+            for s in res["candidates"] or [res["primary"]]:
+                meta = feature_map.get(s)
+                if meta is None:
+                    meta = feature_map[s] = {"title": s, "include": set()}
+                meta["include"].add(rel)
+
+        for slug, toks in res["toks_by_feat"].items():
+            merge_token_index(tokens_db, TAXONOMY_VERSION, model, slug, rel, toks)
+        persistor.mark_dirty()
+
+    # Files with identical content go to the LLM once: later copies wait for the
+    # first one's result (keyed by cache key, i.e. content hash) and reuse it.
+    first_by_key: Dict[str, Optional[Dict]] = {}  # None while the first copy is in flight
+    duplicates: Dict[str, List[Dict]] = defaultdict(list)
+
+    def pending_only(scans: Iterable[Dict]) -> Iterator[Dict]:
+        for res in scans:
+            if not res.get("pending"):
+                merge_result(res)
+            elif res["key"] not in first_by_key:
+                first_by_key[res["key"]] = None
+                yield res
+            elif first_by_key[res["key"]] is None:
+                duplicates[res["key"]].append(res)
+            else:
+                merge_result(_duplicate_result(ctx, res, first_by_key[res["key"]]))
+
+    def merge_classified(res: Dict):
+        merge_result(res)
+        key = res["key"]
+        first_by_key[key] = res
+        for dup in duplicates.pop(key, ()):
+            merge_result(_duplicate_result(ctx, dup, res))
+
+    n_changed = n_requests = 0
+    with ThreadPoolExecutor(max_workers=ctx.concurrency) as ex:
+        inflight = set()
+
+        def drain(block: bool):
+            nonlocal inflight
+            done, inflight = wait(inflight, timeout=None if block else 0,
+                                  return_when=FIRST_COMPLETED)
+            for fut in done:
+                for res in fut.result():
+                    merge_classified(res)
+
+        scans = pending_only(prefetch_scans(jobs, depth=ctx.concurrency + 1))
+        for batch in iter_batches(scans, max_files=1 if ctx.two_call else ctx.batch_size):
+            n_changed += len(batch)
+            n_requests += 1
+            # Backpressure: at most `concurrency` batches queued or running, so the
+            # scan side can't read and summarize the whole repo ahead of the LLM.
+            while len(inflight) >= ctx.concurrency:
+                drain(block=True)
+            inflight.add(ex.submit(classify_batch, ctx, batch))
+            drain(block=False)
+        while inflight:
+            drain(block=True)
+    if n_changed:
+        logger.info("Classified %d changed files in %d batched requests", n_changed, n_requests)
+
+    # Persist artifacts.
+    persistor.close()
+    classify_cache.close()
+    summaries.prune(rel for _, rel in rs_files)
+    summaries.close()
     save_tokens_db(tokens_db)
     write_feature_map_json(feature_map)
-    write_feature_docs(feature_map, file_code_map, tokens_db)
+    write_feature_docs(feature_map, file_paths, tokens_db)
 
     # Final summary
     print(f"Processed {len(rs_files)} Rust files.")
@@ -750,13 +1841,11 @@ def main():
 
     if FAILED_CALLS:
         print("\n--- LLM API failures / parse issues ---")
-        by_phase: Dict[str, int] = {}
-        for rec in FAILED_CALLS:
-            by_phase[rec["phase"]] = by_phase.get(rec["phase"], 0) + 1
+        by_phase = Counter(rec["phase"] for rec in FAILED_CALLS)
         for phase, count in sorted(by_phase.items()):
             print(f"{phase}: {count}")
         # Optionally dump a JSON for debugging
-        (OUT_DIR / "llm_failures.json").write_text(json.dumps(FAILED_CALLS, indent=2, ensure_ascii=False))
+        (OUT_DIR / "llm_failures.json").write_bytes(dump_json(FAILED_CALLS))
         print(f"Details: {OUT_DIR}/llm_failures.json")
     else:
         print("LLM API: all calls succeeded.")
@@ -0,0 +1,214 @@
+"""Regression tests for the pure helpers in gen.py (no LM server needed).
+
+Run with `python -m unittest test_gen` (or pytest) from the repo root.
+"""
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# gen.py creates .cache/ under the current directory at import time; keep that
+# out of the repo.
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+_TMP = tempfile.TemporaryDirectory()
+_cwd = os.getcwd()
+os.chdir(_TMP.name)
+try:
+    import gen
+finally:
+    os.chdir(_cwd)
+gen.logger.setLevel(logging.WARNING)
+
+FILES = [("a.rs", "summary a"), ("b.rs", "summary b")]
+SCORES = {"layout": 0.9, "rendering": 0.2}
+
+
+def chat(content: str) -> dict:
+    """A chat-completions response carrying `content`, as http_json_chat returns it."""
+    return {"choices": [{"message": {"content": content}}]}
+
+
+class JsonObjectEndTest(unittest.TestCase):
+    def test_nested(self):
+        s = 'x {"a": {"b": 1}} tail'
+        self.assertEqual(s[2:gen._json_object_end(s, 2)], '{"a": {"b": 1}}')
+
+    def test_braces_and_escaped_quotes_in_strings(self):
+        s = '{"a": "}{ \\" }", "b": 2} {junk}'
+        self.assertEqual(s[:gen._json_object_end(s, 0)], '{"a": "}{ \\" }", "b": 2}')
+
+    def test_unclosed(self):
+        self.assertEqual(gen._json_object_end('{"a": {"b": 1}', 0), -1)
+
+    def test_extract_from_fence_with_trailing_prose(self):
+        s = 'Sure!\n```json\n{"scores": {}}\n```\nHope this helps. {not json}'
+        self.assertEqual(gen._extract_json_blob(s), '{"scores": {}}')
+
+
+class JsonStreamScannerTest(unittest.TestCase):
+    def feed_all(self, text: str, step: int = 7):
+        scanner = gen._JsonStreamScanner()
+        for i in range(0, len(text), step):
+            if scanner.feed(text[i:i + step]):
+                return scanner, i + step
+        return scanner, None
+
+    def test_stops_once_object_is_complete(self):
+        text = 'Sure!\n```json\n{"scores": {"layout": 0.9}, "note": "a } b"}\n```\nMore prose {x}'
+        scanner, stopped_at = self.feed_all(text)
+        self.assertEqual(scanner.result, {"scores": {"layout": 0.9}, "note": "a } b"})
+        self.assertLess(stopped_at, len(text))
+
+    def test_skips_unparseable_brace_pairs_in_prose(self):
+        scanner, _ = self.feed_all('The file {path} has "quotes" and {"primary": "layout"}')
+        self.assertEqual(scanner.result, {"primary": "layout"})
+
+    def test_incomplete_object(self):
+        scanner, stopped_at = self.feed_all('{"scores": {"layout": 0.9}')
+        self.assertIsNone(stopped_at)
+        self.assertIsNone(scanner.result)
+
+    def test_read_event_stream_hangs_up_after_object(self):
+        lines = [b'data: {"choices": [{"delta": {"content": "{\\"a\\": "}}]}', b"",
+                 b'data: {"choices": [{"delta": {"content": "1} and more"}}]}',
+                 b'data: {"choices": [{"delta": {"content": " never read"}}]}',
+                 b"data: [DONE]"]
+        consumed = []
+
+        class Response:
+            def iter_lines(self):
+                for line in lines:
+                    consumed.append(line)
+                    yield line
+
+        self.assertEqual(gen._read_event_stream(Response()), '{"a": 1} and more')
+        self.assertEqual(len(consumed), 3)
+
+
+class BatchRowsTest(unittest.TestCase):
+    def test_well_formed(self):
+        raw = {"results": [
+            {"idx": 2, "scores": SCORES, "primary": "layout", "features": {"layout": ["measure policy"]}},
+            {"idx": "1", "scores": SCORES, "primary": "rendering"},
+        ]}
+        out = gen._batch_rows(raw, FILES)
+        self.assertEqual(out["b.rs"], ({"scores": SCORES, "primary": "layout", "confidence": 0.0},
+                                       {"layout": [{"token": "measure policy", "weight": 0.6}]}))
+        self.assertEqual(out["a.rs"][0]["primary"], "rendering")
+        self.assertEqual(out["a.rs"][1], {})
+
+    def test_malformed_shapes_are_missing_rows(self):
+        for raw in (None, [], "x", {}, {"results": None}, {"results": {"1": {"scores": SCORES}}},
+                    {"results": ["a", "b"]}, {"results": [[1, SCORES]]}):
+            with self.subTest(raw=raw):
+                self.assertEqual(gen._batch_rows(raw, FILES), {})
+
+    def test_bad_rows_are_skipped(self):
+        raw = {"results": [
+            {"idx": 0, "scores": SCORES},       # idx is 1-based
+            {"idx": 3, "scores": SCORES},       # out of range
+            {"idx": "one", "scores": SCORES},
+            {"scores": SCORES},
+            {"idx": 1, "scores": [0.9]},        # scores must be an object
+            {"idx": 1, "scores": {"layout": "high"}},
+            {"idx": 1, "scores": {"layout": 0.9, "input": None}},
+            {"idx": 1, "scores": SCORES, "features": ["layout"]},
+            {"idx": 1, "scores": SCORES, "features": {"layout": None}},
+            {"idx": 2, "scores": SCORES, "confidence": 0.7},
+            {"idx": 2, "scores": {}, "primary": "late duplicate"},
+        ]}
+        self.assertEqual(gen._batch_rows(raw, FILES),
+                         {"b.rs": ({"scores": SCORES, "primary": "unknown", "confidence": 0.7}, {})})
+
+    def test_malformed_batch_falls_back_to_single_file_calls(self):
+        def fake_chat(payload, phase, relpath, **kw):
+            if phase == "score_batch":
+                return chat('{"results": {"1": {"scores": {}}}}')
+            return chat('{"scores": {"layout": 0.9}, "primary": "layout", "confidence": 0.8}')
+
+        jobs = [{"idx": i, "rel": rel, "path": rel, "key": rel, "summary": summary}
+                for i, (rel, summary) in enumerate(FILES, 1)]
+        with mock.patch.object(gen, "http_json_chat", side_effect=fake_chat) as m:
+            results = gen.classify_batch(gen.RunCtx(total_files=2), jobs)
+        self.assertEqual([c.kwargs["phase"] for c in m.call_args_list],
+                         ["score_batch", "score_and_tokens", "score_and_tokens"])
+        self.assertEqual([(r["rel"], r["primary"]) for r in results], [("a.rs", "layout"), ("b.rs", "layout")])
+
+
+class AnswerShapeTest(unittest.TestCase):
+    def classify(self, content: str, two_call: bool = False) -> dict:
+        job = {"idx": 1, "rel": "a.rs", "path": "a.rs", "key": "k", "summary": "s"}
+        with mock.patch.object(gen, "http_json_chat", return_value=chat(content)):
+            return gen.classify_batch(gen.RunCtx(total_files=1, two_call=two_call), [job])[0]
+
+    def test_wrong_shapes_fail_instead_of_raising(self):
+        for content in ('{"scores": {"layout": 0.9}, "primary": "layout", "features": ["layout"]}',
+                        '{"scores": {"layout": 0.9}, "primary": "layout", "features": {"layout": null}}',
+                        '{"scores": null, "primary": "layout"}',
+                        '{"scores": [0.9], "primary": "layout"}',
+                        '"layout"'):
+            for two_call in (False, True):
+                with self.subTest(content=content, two_call=two_call), self.assertLogs(gen.logger, "ERROR"):
+                    res = self.classify(content, two_call)
+                    self.assertEqual((res["primary"], res["entry"], res["toks_by_feat"]), ("unknown", None, {}))
+
+    def test_failures_are_not_cached(self):
+        jobs = [{"idx": i, "rel": rel, "path": rel, "key": rel, "summary": summary}
+                for i, (rel, summary) in enumerate(FILES, 1)]
+        for answer in (None, chat("Sorry, no JSON here"), chat('{"scores": {"layout": 0.9')):
+            for two_call in (False, True):
+                with self.subTest(answer=answer, two_call=two_call), self.assertLogs(gen.logger, "WARNING"):
+                    with mock.patch.object(gen, "http_json_chat", return_value=answer):
+                        results = gen.classify_batch(gen.RunCtx(total_files=2, two_call=two_call), jobs)
+                    self.assertEqual([(r["primary"], r["entry"], r["key"]) for r in results],
+                                     [("unknown", None, "a.rs"), ("unknown", None, "b.rs")])
+
+    def test_empty_scores_are_a_real_answer(self):
+        res = self.classify('{"scores": {}, "primary": "unknown", "confidence": 0.0}')
+        self.assertTrue(res["entry"]["no_candidates"])
+
+    def test_odd_values_are_cleaned_up(self):
+        res = self.classify('{"scores": {"layout": 0.9, "input": "0.9", "modifiers": null}, "primary": ["layout"],'
+                            ' "confidence": "high", "features": {"layout": [{"token": "measure policy", "weight": "high"},'
+                            ' {"token": "placeable", "weight": "0.8"}, "constraints", 7]}}')
+        self.assertEqual(res["candidates"], ["layout"])
+        self.assertEqual(res["primary"], "unknown")
+        self.assertEqual(res["toks_by_feat"], {"layout": [{"token": "measure policy", "weight": 0.6},
+                                                          {"token": "placeable", "weight": 0.8},
+                                                          {"token": "constraints", "weight": 0.6}]})
+
+
+class KeywordFastPathTest(unittest.TestCase):
+    def test_path_line_does_not_vote(self):
+        body = "PUBLIC_APIS:\n- pub fn layout()\n"
+        path = "render/pixels/draw_renderer_gpu_wgpu_render_draw_pixels.rs"
+        self.assertIsNone(gen.keyword_classify(gen.SUMMARY_PATH_PREFIX + path + "\n\n" + body))
+
+    def test_every_feature_has_keywords(self):
+        self.assertEqual(set(gen.FEATURE_KEYWORDS), {f["slug"] for f in gen.FEATURES})
+
+    def test_fast_path_entries_are_upgradable(self):
+        entry = {"key": "k", "primary": "layout", "scores": SCORES, "keywords": gen.KEYWORD_TABLE_VERSION}
+        self.assertTrue(gen._reusable(gen.RunCtx(), entry, "k"))
+        self.assertFalse(gen._reusable(gen.RunCtx(keyword_fast_path=False), entry, "k"))
+        self.assertFalse(gen._reusable(gen.RunCtx(), {**entry, "keywords": 0}, "k"))
+        self.assertTrue(gen._reusable(gen.RunCtx(keyword_fast_path=False), {"key": "k"}, "k"))
+        self.assertFalse(gen._reusable(gen.RunCtx(), {"key": "old"}, "k"))
+
+
+class TokenBudgetTest(unittest.TestCase):
+    def test_char_fallback_honours_limit(self):
+        text = "word " * 2000
+        with mock.patch.object(gen, "_ENC", None):
+            for limit in (100, gen.MAX_PROMPT_TOKENS):
+                with self.subTest(limit=limit):
+                    self.assertLessEqual(gen.count_tokens(gen.truncate_tokens(text, limit)), limit)
+            full = gen.truncate_tokens("x" * 50000, gen.MAX_PROMPT_TOKENS)
+            self.assertLessEqual(gen.count_tokens(full), gen.SCORE_BATCH_TOKENS)
+
+
+if __name__ == "__main__":
+    unittest.main()